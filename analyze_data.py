@@ -1,3 +1,4 @@
+import io
 import os
 import warnings
 import zipfile
@@ -5,11 +6,13 @@ import zipfile
 import nept
 import numpy as np
 import scipy
+import scipy.io
 from shapely.geometry import CAP_STYLE, LineString, Point
 
 import meta
 import meta_session
 import paths
+from stores import LFPPyramid, LFPStore, SpikeStore
 from tasks import task
 
 warnings.filterwarnings("ignore")
@@ -35,6 +38,37 @@ def extract_xy(target):
     return x, y
 
 
+def decode_targets(targets):
+    """Extracts x and y from a matrix of neuralynx targets.
+
+    Vectorized equivalent of calling `extract_xy` on every target.
+    Each record contains up to 50 targets, each stored in a 32bit field,
+    with X at bits [1:12] and Y at bits [17:28] (i.e. [20:31] and [4:15]
+    of the binary string used by `extract_xy`). When a field is equal to
+    zero there is no valid data for that field and it remains zero for
+    the rest of the fields in the record.
+
+    Parameters
+    ----------
+    targets: np.array
+        Shape (n_samples, n_targets)
+
+    Returns
+    -------
+    x: np.array
+    y: np.array
+
+    """
+    # abs matches extract_xy's binary formatting of fields with the sign bit set
+    fields = np.abs(np.asarray(targets).astype(np.int64))
+    valid = np.cumprod(fields != 0, axis=1).astype(bool)
+
+    x = np.where(valid, (fields >> 1) & 0x7FF, 0).astype(float)
+    y = np.where(valid, (fields >> 17) & 0x7FF, 0).astype(float)
+
+    return x, y
+
+
 def median_filter(x, y, kernel):
     # Applying a median filter to the x and y positions
 
@@ -76,15 +110,279 @@ def unzip_nvt_file(datapath, filename):
         file.extractall(datapath)
 
 
+# The format for .nvt records according the the neuralynx docs is
+# uint16 x 3 - beginning of the record, ID for the system, size of videorec in bytes
+# uint64 - timestamp in microseconds
+# uint32 x 400 - points with the color bitfield values
+# int16 - unused
+# int32 - extracted X location of target
+# int32 - extracted Y location of target
+# int32 - calculated head angle in degrees clockwise from the positive Y axis
+# int32 x 50 - colored targets using the same bitfield format as the points
+nvt_header_size = 16 * 2**10
+nvt_dtype = np.dtype(
+    [
+        ("filler1", "<h", 3),
+        ("time", "<Q"),
+        ("points", "<i", 400),
+        ("filler2", "<h"),
+        ("x", "<i"),
+        ("y", "<i"),
+        ("head_angle", "<i"),
+        ("targets", "<i", 50),
+    ]
+)
+
+
+def read_nvt(fileobj, size):
+    """Reads neuralynx videotracking records from an open binary file object.
+
+    Records are read straight into a preallocated array, so this works on
+    non-seekable streams (eg. a ZipFile member) without a temporary copy.
+
+    Parameters
+    ----------
+    fileobj: file-like
+    size: int
+        Size of the .nvt file in bytes, including the header.
+
+    Returns
+    -------
+    nvt_data: dict
+        With time, x, y and targets as keys, like nept.load_nvt(remove_empty=False).
+
+    """
+    # Neuralynx files have a 16kbyte header
+    fileobj.read(nvt_header_size)
+
+    data = np.empty((size - nvt_header_size) // nvt_dtype.itemsize, dtype=nvt_dtype)
+    buffer = memoryview(data.view(np.uint8).reshape(-1))
+    n_read = 0
+    while n_read < len(buffer):
+        n = fileobj.readinto(buffer[n_read:])
+        if not n:
+            break
+        n_read += n
+    data = data[: n_read // nvt_dtype.itemsize]
+
+    nvt_data = dict()
+    nvt_data["time"] = data["time"] * 1e-6
+    nvt_data["x"] = np.array(data["x"], dtype=float)
+    nvt_data["y"] = np.array(data["y"], dtype=float)
+    nvt_data["targets"] = np.array(data["targets"], dtype=float)
+    return nvt_data
+
+
+def load_zipped_nvt(zip_path):
+    """Loads a videotracking (*.nvt) file directly from its zip archive
+
+    Parameters
+    ----------
+    zip_path: str
+
+    Returns
+    -------
+    nvt_data: dict
+
+    """
+    with zipfile.ZipFile(zip_path, "r") as file:
+        (member,) = [
+            zinfo for zinfo in file.infolist() if zinfo.filename.endswith(".nvt")
+        ]
+        with file.open(member) as fileobj:
+            return read_nvt(fileobj, member.file_size)
+
+
+# The format for .ncs files according to the neuralynx docs is
+# uint64 - timestamp in microseconds
+# uint32 - channel number
+# uint32 - sample freq
+# uint32 - number of valid samples
+# int16 x 512 - actual csc samples
+ncs_header_size = 16 * 2**10
+ncs_block = 512
+ncs_dtype = np.dtype(
+    [
+        ("time", "<Q"),
+        ("channel", "<i"),
+        ("freq", "<i"),
+        ("valid", "<i"),
+        ("csc", "<h", (ncs_block,)),
+    ]
+)
+
+
+def load_ncs(filename):
+    """Loads a neuralynx .ncs electrode file through a memory map.
+
+    Same output as nept.load_ncs, but sample times are assigned without a
+    loop over blocks and the records are not copied into memory first.
+    As in nept, times are packed by the number of valid samples in each
+    block, so samples past the total number of valid samples have time == 0.
+
+    Parameters
+    ----------
+    filename: str
+
+    Returns
+    -------
+    cscs: np.array
+        Voltage trace (V)
+    times: np.array
+        Timestamps (s)
+
+    """
+    with open(filename, "rb") as f:
+        header = f.read(ncs_header_size)
+
+    analog_to_digital = None
+    for line in header.split(b"\n"):
+        if line.strip().startswith(b"-ADBitVolts"):
+            analog_to_digital = float(line.split(b" ")[1].decode())
+    if analog_to_digital is None:
+        raise IOError(f"ADBitVolts not found in .ncs header for {filename}")
+
+    data = np.memmap(filename, dtype=ncs_dtype, mode="r", offset=ncs_header_size)
+
+    frequency = np.unique(data["freq"])
+    if len(frequency) > 1:
+        raise IOError("only one frequency allowed")
+    frequency = frequency[0]
+
+    # .ncs files have a timestamp for every block of 512 samples, some of
+    # which may be invalid. Each valid sample is offset from its block's time.
+    n_valid = np.asarray(data["valid"], dtype=int)
+    block_starts = np.cumsum(n_valid) - n_valid
+    within_block = np.arange(n_valid.sum()) - np.repeat(block_starts, n_valid)
+    offsets = np.arange(0, ncs_block / frequency, 1.0 / frequency)
+    times = np.zeros(data.size * ncs_block)
+    times[: within_block.size] = (
+        np.repeat(data["time"] * 1e-6, n_valid) + offsets[within_block]
+    )
+
+    cscs = (data["csc"] * analog_to_digital).reshape(-1)
+    return cscs, times
+
+
+def load_lfp(filename):
+    """Loads a neuralynx .ncs file as an LFPStore.
+
+    Samples with time == 0 (past the last valid sample) are dropped.
+
+    Parameters
+    ----------
+    filename: str
+
+    Returns
+    -------
+    lfp: LFPStore
+
+    """
+    cscs, times = load_ncs(filename)
+    keep = times > 0
+    return LFPStore.from_lfp(nept.LocalFieldPotential(cscs[keep], times[keep]))
+
+
+def remove_based_on_std(targets, std_thresh):
+    """Removes the target furthest from the previous location in noisy samples.
+
+    For each sample where the std across targets is above std_thresh, the
+    target furthest from the mean of the previous non-nan sample is set to nan.
+    The previous mean is taken after its own removal, so chains of consecutive
+    problem samples are resolved by iterating to a fixed point; each pass fixes
+    at least one more sample of every chain. The number of passes is thus
+    bounded by the length of the longest chain, which makes the worst case
+    quadratic in the number of samples, but noisy samples come in short runs.
+
+    Parameters
+    ----------
+    targets: np.array
+        Shape (n_samples, n_targets)
+    std_thresh: float
+
+    Returns
+    -------
+    targets: np.array
+
+    """
+    targets = np.array(targets)
+    means = np.nanmean(targets, axis=1)
+    valid = ~np.isnan(means)
+
+    # find idx where there is a large variation between targets
+    problem_samples = np.where(np.nanstd(targets, axis=1) > std_thresh)[0]
+    if problem_samples.size == 0:
+        return targets
+
+    # Forward-fill the index of the previous non-nan sample. Removing a target
+    # from a problem sample leaves at least one, so this never changes.
+    last_valid = np.maximum.accumulate(np.where(valid, np.arange(means.size), -1))
+    previous_idx = np.hstack(([-1], last_valid[:-1]))[problem_samples]
+    # Without an earlier sample, compare to the last one (as negative indexing did)
+    no_previous = previous_idx < 0
+    wrapped_mean = means[valid][-1]
+
+    problem_targets = targets[problem_samples]
+    rows = np.arange(problem_samples.size)
+    removed = None
+    while True:
+        previous_mean = np.where(no_previous, wrapped_mean, means[previous_idx])
+        deviation = np.abs(problem_targets - previous_mean[:, np.newaxis])
+        deviation[np.isnan(deviation)] = -np.inf
+        new_removed = np.argmax(deviation, axis=1)
+        if removed is not None and np.array_equal(new_removed, removed):
+            break
+        removed = new_removed
+
+        remaining = np.array(problem_targets)
+        remaining[rows, removed] = np.nan
+        means[problem_samples] = np.nanmean(remaining, axis=1)
+
+    targets[problem_samples, removed] = np.nan
+    return targets
+
+
+def label_samples(n_samples, starts_idx, stops_idx):
+    """Labels each sample with the interval [start, stop) that contains it.
+
+    Both starts_idx and stops_idx must be non-decreasing, so the last interval
+    starting at or before a sample is the only candidate to contain it. Where
+    intervals overlap, the later interval takes precedence.
+
+    Parameters
+    ----------
+    n_samples: int
+    starts_idx: np.array
+    stops_idx: np.array
+
+    Returns
+    -------
+    labels: np.array
+        Index of the interval for each sample, or -1 if in no interval.
+
+    """
+    starts_idx = np.asarray(starts_idx, dtype=int)
+    stops_idx = np.maximum(np.asarray(stops_idx, dtype=int), starts_idx)
+    assert np.all(np.diff(starts_idx) >= 0) and np.all(np.diff(stops_idx) >= 0)
+
+    samples = np.arange(n_samples)
+    labels = np.searchsorted(starts_idx, samples, side="right") - 1
+    contained = labels >= 0
+    contained[contained] = stops_idx[labels[contained]] > samples[contained]
+    labels[~contained] = -1
+    return labels
+
+
 def load_shortcut_position(
-    info, filename, events, task_times, dist_thresh=20.0, std_thresh=2.0
+    info, nvt_data, events, task_times, dist_thresh=20.0, std_thresh=2.0
 ):
     """Loads and corrects shortcut position.
 
     Parameters
     ----------
     info: module
-    filename: str
+    nvt_data: dict
+        Raw videotracking data, as from nept.load_nvt(remove_empty=False)
     events: dict
     dist_thresh: float
     std_thresh: float
@@ -94,28 +392,11 @@ def load_shortcut_position(
     position: nept.Position
 
     """
-    # Load raw position from file
-    nvt_data = nept.load_nvt(filename, remove_empty=False)
     targets = nvt_data["targets"]
     times = nvt_data["time"]
 
-    # Initialize x, y arrays
-    x = np.zeros(targets.shape)
-    y = np.zeros(targets.shape)
-
-    # X and Y are stored in a custom bitfield. See Neuralynx data file format
-    # documentation for details.
-    # Briefly, each record contains up to 50 targets, each stored in 32bit field.
-    # X field at [20:31] and Y at [4:15].
-    # TODO: make into a separate function in nept
-    for target in range(targets.shape[1]):
-        this_sample = targets[:, target]
-        for sample in range(targets.shape[0]):
-            # When the bitfield is equal to zero there is no valid data for that field
-            # and remains zero for the rest of the bitfields in the record.
-            if this_sample[target] == 0:
-                break
-            x[sample, target], y[sample, target] = extract_xy(int(this_sample[sample]))
+    # X and Y are stored in a custom bitfield. See decode_targets for details.
+    x, y = decode_targets(targets)
 
     # Replacing targets with no samples with nan instead of 0
     x[x == 0] = np.nan
@@ -133,52 +414,52 @@ def load_shortcut_position(
     leds.extend([(event, "led2") for event in events["led2"]])
     sorted_leds = sorted(leds)
 
+    # Pair each led with the next off event, discounting those when last off missing
     ledoff = events["ledoff"]
+    led_starts = np.array([start for start, _ in sorted_leds])
+    off_idx = np.searchsorted(ledoff, led_starts, side="left")
+    paired = off_idx < len(ledoff)
+    led_feeders = np.array(
+        [
+            info.path_pts["feeder1"] if label == "led2" else info.path_pts["feeder2"]
+            for _, label in sorted_leds
+        ]
+    ).reshape(-1, 2)[paired]
 
     # Get an array of feeder locations when that feeder is actively flashing
-    feeder_x_location = np.empty(times.shape[0]) * np.nan
-    feeder_y_location = np.empty(times.shape[0]) * np.nan
-
-    off_idx = 0
-
-    for start, label in sorted_leds:
-        # Find next off idx
-        while off_idx < len(ledoff) and ledoff[off_idx] < start:
-            off_idx += 1
-
-        # Discount the last event when last off missing
-        if off_idx >= len(ledoff):
-            break
+    led_idx = label_samples(
+        times.size,
+        np.searchsorted(times, led_starts[paired] - off_delay),
+        np.searchsorted(times, ledoff[off_idx[paired]] + off_delay),
+    )
 
-        x_location = (
-            info.path_pts["feeder1"][0]
-            if label == "led2"
-            else info.path_pts["feeder2"][0]
-        )
-        y_location = (
-            info.path_pts["feeder1"][1]
-            if label == "led2"
-            else info.path_pts["feeder2"][1]
+    # Find the problem samples for the sessions that remove them below
+    problem = np.zeros(times.size, dtype=bool)
+    if info.session_id in ["R063d8", "R066d7", "R067d1", "R068d4", "R068d5", "R068d6"]:
+        problem = (
+            label_samples(
+                times.size,
+                nept.find_nearest_indices(times, info.problem_positions.starts),
+                nept.find_nearest_indices(times, info.problem_positions.stops),
+            )
+            >= 0
         )
 
-        feeder_x_location[
-            np.logical_and(
-                times >= start - off_delay, times < ledoff[off_idx] + off_delay
-            )
-        ] = x_location
-        feeder_y_location[
-            np.logical_and(
-                times >= start - off_delay, times < ledoff[off_idx] + off_delay
-            )
-        ] = y_location
+    # Remove problem samples for individual session
+    # While both LEDs are active for R067d1
+    if info.session_id == "R067d1":
+        led_idx[problem] = -1
+
+    active = led_idx >= 0
+    feeder_x_location = np.full(times.size, np.nan)
+    feeder_y_location = np.full(times.size, np.nan)
+    feeder_x_location[active] = led_feeders[led_idx[active], 0]
+    feeder_y_location[active] = led_feeders[led_idx[active], 1]
 
     # Remove problem samples for individual session
     if info.session_id in ["R063d8", "R068d4", "R068d5", "R068d6"]:
-        starts_idx = nept.find_nearest_indices(times, info.problem_positions.starts)
-        stops_idx = nept.find_nearest_indices(times, info.problem_positions.stops)
-        for start, stop in zip(starts_idx, stops_idx):
-            x[start:stop] = np.nan
-            y[start:stop] = np.nan
+        x[problem] = np.nan
+        y[problem] = np.nan
 
     # Remove problem samples for individual session
     # In impossible locations and along the u-trajectory for R066d7
@@ -191,24 +472,12 @@ def load_shortcut_position(
             x[remove_idx] = np.nan
             y[remove_idx] = np.nan
 
-        starts_idx = nept.find_nearest_indices(times, info.problem_positions.starts)
-        stops_idx = nept.find_nearest_indices(times, info.problem_positions.stops)
-        for start, stop in zip(starts_idx, stops_idx):
-            x_idx = x[start:stop] <= 100.0
-            y_idx = y[start:stop] <= 60.0
-            remove_idx = x_idx & y_idx
+        x_idx = x <= 100.0
+        y_idx = y <= 60.0
+        remove_idx = problem[:, np.newaxis] & x_idx & y_idx
 
-            x[start:stop][remove_idx] = np.nan
-            y[start:stop][remove_idx] = np.nan
-
-    # Remove problem samples for individual session
-    # While both LEDs are active for R067d1
-    if info.session_id == "R067d1":
-        starts_idx = nept.find_nearest_indices(times, info.problem_positions.starts)
-        stops_idx = nept.find_nearest_indices(times, info.problem_positions.stops)
-        for start, stop in zip(starts_idx, stops_idx):
-            feeder_x_location[start:stop] = np.nan
-            feeder_y_location[start:stop] = np.nan
+        x[remove_idx] = np.nan
+        y[remove_idx] = np.nan
 
     # Remove problem samples for individual session
     # In impossible locations for R068d3
@@ -241,31 +510,8 @@ def load_shortcut_position(
     y[remove_idx] = np.nan
 
     # Removing the problem samples that are furthest from the previous location
-    def remove_based_on_std(original_targets, std_thresh=std_thresh):
-        targets = np.array(original_targets)
-        stds = np.nanstd(targets, axis=1)[:, np.newaxis]
-
-        # find idx where there is a large variation between targets
-        problem_samples = np.where(stds > std_thresh)[0]
-
-        for i in problem_samples:
-            # find the previous mean to help determine which target is an issue
-            previous_idx = i - 1
-            previous_mean = np.nanmean(targets[previous_idx])
-
-            # if previous sample is nan, compare current sample to the one before that
-            while np.isnan(previous_mean):
-                previous_idx -= 1
-                previous_mean = np.nanmean(targets[previous_idx])
-
-            # remove problem target
-            idx = np.nanargmax(np.abs(targets[i] - previous_mean))
-            targets[i][idx] = np.nan
-
-        return targets
-
-    x = remove_based_on_std(x)
-    y = remove_based_on_std(y)
+    x = remove_based_on_std(x, std_thresh)
+    y = remove_based_on_std(y, std_thresh)
 
     # Calculating the mean of the remaining targets
     x = np.nanmean(x, axis=1)
@@ -322,6 +568,49 @@ def load_shortcut_position(
     return position
 
 
+def save_position_mat(position, filename):
+    """Saves position as a MATLAB .mat file with x, y and time vectors.
+
+    The file is built in memory and written to disk in a single write.
+
+    Parameters
+    ----------
+    position: nept.Position
+    filename: str
+
+    """
+    buffer = io.BytesIO()
+    scipy.io.savemat(buffer, {"x": position.x, "y": position.y, "time": position.time})
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, "wb") as fileobj:
+        fileobj.write(buffer.getbuffer())
+
+
+def save_position_csv(position, filename):
+    """Saves position as a csv with x, y and time columns.
+
+    Parameters
+    ----------
+    position: nept.Position
+    filename: str
+
+    """
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    np.savetxt(
+        filename,
+        np.hstack(
+            (
+                position.x[:, np.newaxis],
+                position.y[:, np.newaxis],
+                position.time[:, np.newaxis],
+            )
+        ),
+        delimiter=",",
+        header="x,y,time",
+        comments="",
+    )
+
+
 @task(infos=meta_session.all_infos, cache_saves="events")
 def cache_events(info):
     """Cache raw event data in .pkl"""
@@ -354,10 +643,8 @@ def cache_task_times(info, *, events, lfp_swr):
 
     task_times = {}
     for i, task_time in enumerate(meta.task_times):
-        start = events["start"][i]
-        start = lfp_swr.time[lfp_swr.time >= start][0]
-        stop = events["stop"][i]
-        stop = lfp_swr.time[lfp_swr.time <= stop][-1]
+        start = lfp_swr.time[lfp_swr.sample_slice(events["start"][i], np.inf)][0]
+        stop = lfp_swr.time[lfp_swr.sample_slice(-np.inf, events["stop"][i])][-1]
         task_times[task_time] = nept.Epoch([start], [stop])
 
     maze_times = nept.Epoch([], [])
@@ -378,24 +665,46 @@ def cache_task_times(info, *, events, lfp_swr):
     return task_times
 
 
-@task(infos=meta_session.all_infos, cache_saves="lfp_swr")
+# LFP channels are large and only needed by some analyses, so they are only
+# cached when a selected task depends on them.
+@task(
+    infos=meta_session.all_infos,
+    cache_saves="lfp_swr",
+    on_demand=True,
+    raw_inputs=lambda info: [paths.lfp_swr_file(info)],
+)
 def cache_lfp_swr(info):
-    """Cache raw lfp_swr data in .pkl"""
-    lfp_swr = nept.load_lfp(paths.lfp_swr_file(info))
+    """Cache raw lfp_swr data as memory-mapped .npy arrays"""
     # In one case, the last 3000 or so samples end up with time == 0
-    lfp_swr = lfp_swr[lfp_swr.time > 0]
-    return lfp_swr
+    return load_lfp(paths.lfp_swr_file(info))
 
 
-@task(infos=meta_session.all_infos, cache_saves="lfp_theta")
+@task(
+    infos=meta_session.all_infos,
+    cache_saves="lfp_theta",
+    on_demand=True,
+    raw_inputs=lambda info: [paths.lfp_theta_file(info)],
+)
 def cache_lfp_theta(info):
-    """Cache raw lfp_theta data in .pkl"""
-    return nept.load_lfp(paths.lfp_theta_file(info))
+    """Cache raw lfp_theta data as memory-mapped .npy arrays"""
+    return load_lfp(paths.lfp_theta_file(info))
+
+
+@task(infos=meta_session.all_infos, cache_saves="lfp_swr_pyramid", on_demand=True)
+def cache_lfp_swr_pyramid(info, *, lfp_swr):
+    """Cache min/max decimation pyramid of lfp_swr for plotting"""
+    return LFPPyramid.from_lfp(lfp_swr)
+
+
+@task(infos=meta_session.all_infos, cache_saves="lfp_theta_pyramid", on_demand=True)
+def cache_lfp_theta_pyramid(info, *, lfp_theta):
+    """Cache min/max decimation pyramid of lfp_theta for plotting"""
+    return LFPPyramid.from_lfp(lfp_theta)
 
 
 @task(infos=meta_session.all_infos, cache_saves="spikes")
 def cache_spikes(info, *, task_times):
-    """Cache raw spike data in .pkl"""
+    """Cache raw spike data as a SpikeStore in .pkl"""
 
     recording_dir = paths.recording_dir(info)
     spikes = nept.load_spikes(recording_dir, load_questionable=meta.load_questionable)
@@ -411,7 +720,7 @@ def cache_spikes(info, *, task_times):
     ]
 
     # Remove neurons that have fewer than min_spikes spikes (100)
-    return np.asarray(
+    return SpikeStore.from_spiketrains(
         [spiketrain for spiketrain in spikes if spiketrain.n_spikes > meta.min_spikes]
     )
 
@@ -419,30 +728,22 @@ def cache_spikes(info, *, task_times):
 @task(infos=meta_session.all_infos, cache_saves="position")
 def cache_position(info, *, events, task_times):
     """Cache raw position data in .pkl"""
-    recording_dir = paths.recording_dir(info)
-
-    unzip_nvt_file(recording_dir, f"{info.session}-VT1")
-    position = load_shortcut_position(
-        info, paths.position_file(info), events, task_times
-    )
-    os.remove(paths.position_file(info))
-
-    # Save position as csv for ease of use in matlab
-    csv = paths.position_csv_file(info)
-    np.savetxt(
-        csv,
-        np.hstack(
-            (
-                position.x[:, np.newaxis],
-                position.y[:, np.newaxis],
-                position.time[:, np.newaxis],
-            )
-        ),
-        delimiter=",",
-        header="x,y,time",
-        comments="",
-    )
-    print(f"Saved {csv}")
+    if meta.unzip_nvt:
+        recording_dir = paths.recording_dir(info)
+        unzip_nvt_file(recording_dir, f"{info.session}-VT1")
+        nvt_data = nept.load_nvt(paths.position_file(info), remove_empty=False)
+        os.remove(paths.position_file(info))
+    else:
+        nvt_data = load_zipped_nvt(paths.position_zip_file(info))
+    position = load_shortcut_position(info, nvt_data, events, task_times)
+
+    # Save position for ease of use in matlab
+    if "mat" in meta.position_exports:
+        save_position_mat(position, paths.position_mat_file(info))
+        print(f"Saved {paths.position_mat_file(info)}")
+    if "csv" in meta.position_exports:
+        save_position_csv(position, paths.position_csv_file(info))
+        print(f"Saved {paths.position_csv_file(info)}")
 
     return position
 
@@ -507,6 +808,7 @@ def cache_lines_zones(info):
 
 @task(infos=meta_session.all_infos, cache_saves="lines_matched")
 def cache_lines_matched(info, *, lines, raw_matched_linear):
+    lines = dict(lines)  # Loaded inputs are shared with other tasks
     for trajectory in meta.trajectories:
         linear = raw_matched_linear[trajectory]
         start = lines[trajectory].interpolate(np.min(linear.x))
@@ -84,8 +84,11 @@ def cache_raw_matched_linear(info, *, raw_linear, lines):
 
     raw_u = raw_linear["u"]
     matched_u = raw_u[(raw_u.x >= u_start) & (raw_u.x <= u_end)]
-    raw_full_shortcut = raw_linear["full_shortcut"]
-    raw_full_shortcut.x -= full_shortcut_offset
+    # Loaded inputs are read-only, so shift a copy
+    raw_full_shortcut = nept.Position(
+        raw_linear["full_shortcut"].x - full_shortcut_offset,
+        raw_linear["full_shortcut"].time,
+    )
     matched_full_shortcut = raw_full_shortcut[
         (raw_full_shortcut.x >= full_shortcut_start)
         & (raw_full_shortcut.x <= full_shortcut_end)
@@ -95,15 +98,17 @@ def cache_raw_matched_linear(info, *, raw_linear, lines):
 
 @task(infos=meta_session.all_infos, cache_saves="tc_matched_linear")
 def cache_tc_matched_linear(info, *, raw_matched_linear):
-    matched_linear = raw_matched_linear
-    for trajectory in matched_linear:
-        traj_linear = matched_linear[trajectory]
-        traj_linear.x[...] = map_range(
-            traj_linear.x,
-            from_min=np.min(traj_linear.x),
-            from_max=np.max(traj_linear.x),
-            to_min=meta.tc_linear_bin_edges[0],
-            to_max=meta.tc_linear_bin_edges[-1],
+    matched_linear = {}
+    for trajectory, traj_linear in raw_matched_linear.items():
+        matched_linear[trajectory] = nept.Position(
+            map_range(
+                traj_linear.x,
+                from_min=np.min(traj_linear.x),
+                from_max=np.max(traj_linear.x),
+                to_min=meta.tc_linear_bin_edges[0],
+                to_max=meta.tc_linear_bin_edges[-1],
+            ),
+            traj_linear.time,
         )
 
     return matched_linear
@@ -61,7 +61,8 @@ def cache_position_byzone(info, *, position, raw_position_byzone, trials, zones)
     # 'novel' and 'full_shortcut' trials in raw_position_byzone are good
     # but 'u' has overlapping regions cut out, so we re-zone 'u' trials
     # to capture all points in the 'u' trajectory (but not the feeders)
-    position_byzone = raw_position_byzone
+    # Loaded inputs are shared with other tasks
+    position_byzone = dict(raw_position_byzone)
 
     other_trials = nept.Epoch([], [])
     for trial_type in trials:
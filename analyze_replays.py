@@ -131,18 +131,9 @@ def cache_replay_participation(info, *, replays_byphase, spikes):
     participation = {phase: [] for phase in meta.task_times}
 
     for phase in meta.task_times:
-        for replay in replays_byphase["full_shortcut"][phase]:
-            assert replay.n_epochs == 1
-            replay_spikes = [
-                spiketrain.time_slice(replay.start, replay.stop)
-                for spiketrain in spikes
-            ]
-            participation[phase].append(
-                [
-                    spiketrain.n_spikes >= meta.replay_participation_min_spikes
-                    for spiketrain in replay_spikes
-                ]
-            )
+        replays = replays_byphase["full_shortcut"][phase]
+        counts = spikes.interval_counts(replays.starts, replays.stops)
+        participation[phase].extend(counts.T >= meta.replay_participation_min_spikes)
 
     return {
         phase: np.vstack(participation[phase])
@@ -288,19 +279,13 @@ def save_replay_participation_rate_pval(
 def cache_replay_any_unique_participation(
     info, *, tc_order_unique_ph3, replays_byphase, spikes
 ):
-    participation = []
-
-    for replay in replays_byphase["full_shortcut"]["phase3"]:
-        assert replay.n_epochs == 1
-        replay_spikes = [
-            spiketrain.time_slice(replay.start, replay.stop) for spiketrain in spikes
-        ]
-        for ix in tc_order_unique_ph3:
-            if replay_spikes[ix].n_spikes >= meta.replay_participation_min_spikes:
-                participation.append(True)
-                break
-        else:
-            participation.append(False)
+    replays = replays_byphase["full_shortcut"]["phase3"]
+    counts = spikes.interval_counts(replays.starts, replays.stops)
+    participation = list(
+        np.any(
+            counts[tc_order_unique_ph3] >= meta.replay_participation_min_spikes, axis=0
+        )
+    )
 
     assert len(participation) == replays_byphase["full_shortcut"]["phase3"].n_epochs
     return np.array(participation)
@@ -119,9 +119,9 @@ def cache_combined_swr_n_byzone_restonly(
     return aggregate.combine_with_sum(all_swr_n_byzone_restonly)
 
 
-def get_swr_correlation(swr_spikes, rng):
-    active = [len(spikes.time) > 0 for spikes in swr_spikes]
-    if np.sum(active) < meta.min_n_active:
+def get_swr_correlation(swr_neuron_ids, rng):
+    # swr_neuron_ids: tuning curve index of each spike in the SWR, in time order
+    if np.unique(swr_neuron_ids).size < meta.min_n_active:
         return (
             np.nan,
             np.nan,
@@ -129,12 +129,7 @@ def get_swr_correlation(swr_spikes, rng):
             np.ones(meta.n_shuffles + 1) * np.nan,
         )
 
-    spikes_tc_idx = []
-    for i in range(len(swr_spikes)):
-        for time in swr_spikes[i].time:
-            spikes_tc_idx.append((time, i))
-    spikes_tc_idx.sort(key=lambda tup: tup[0])
-    this_swr = [tc_idx for _, tc_idx in spikes_tc_idx]
+    this_swr = list(swr_neuron_ids)
     template_swr = list(sorted(this_swr))
 
     assert len(template_swr) >= meta.min_n_active
@@ -173,13 +168,12 @@ def cache_swr_correlations(info, *, swrs, matched_tc_spikes):
         shuffled = []
         shuffled_p = []
 
-        for swr in swrs:
+        swr_neuron_ids = matched_tc_spikes[trajectory].interval_neuron_ids(
+            swrs.starts, swrs.stops
+        )
+        for neuron_ids in swr_neuron_ids:
             correlation, correlation_p, shuffle, shuffle_p = get_swr_correlation(
-                swr_spikes=[
-                    spiketrain.time_slice(swr.start, swr.stop)
-                    for spiketrain in matched_tc_spikes[trajectory]
-                ],
-                rng=rng,
+                swr_neuron_ids=neuron_ids, rng=rng
             )
             correlations.append(correlation)
             correlations_p.append(correlation_p)
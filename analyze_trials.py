@@ -129,6 +129,7 @@ def cache_trials(info, *, raw_trials, raw_position_byzone, zones, savepath):
 
 @task(infos=meta_session.all_infos, cache_saves="matched_trials")
 def cache_matched_trials(info, *, trials):
+    trials = dict(trials)  # Loaded inputs are shared with other tasks
     n_u_trials = trials["u"].n_epochs
     n_shortcut_trials = trials["full_shortcut"].n_epochs
 
@@ -7,6 +7,7 @@ from shapely.geometry import Point
 import meta
 import meta_session
 import paths
+from stores import SpikeStore
 from tasks import task
 from utils import dist_to_landmark, dist_to_shortcut, latex_float, ranksum_test
 
@@ -30,26 +31,20 @@ def has_field(tuning_curve):
 def restrict_linear_and_spikes(
     linear, spikes, maze_times, trials, *, speed_limit, t_smooth
 ):
+    spikes = SpikeStore.from_spiketrains(spikes)
+
     # restrict to maze times
     linear = linear[maze_times]
-    spikes = [
-        spiketrain.time_slice(maze_times.starts, maze_times.stops)
-        for spiketrain in spikes
-    ]
+    spikes = spikes.time_slice(maze_times.starts, maze_times.stops)
 
     # restrict to trials
     linear = linear[trials]
-    spikes = [
-        spiketrain.time_slice(trials.starts, trials.stops) for spiketrain in spikes
-    ]
+    spikes = spikes.time_slice(trials.starts, trials.stops)
 
     # speed threshold
     run_epoch = nept.run_threshold(linear, thresh=speed_limit, t_smooth=t_smooth)
     linear = linear[run_epoch]
-    spikes = [
-        spiketrain.time_slice(run_epoch.starts, run_epoch.stops)
-        for spiketrain in spikes
-    ]
+    spikes = spikes.time_slice(run_epoch.starts, run_epoch.stops)
     return linear, spikes
 
 
@@ -149,7 +144,7 @@ def cache_raw_tuning_spikes(info, *, full_raw_tuning_spikes, raw_tc_order):
 @task(infos=meta_session.all_infos, cache_saves="raw_tc_spikes")
 def cache_raw_tc_spikes(info, *, spikes, raw_tc_order):
     return {
-        trajectory: [spikes[i] for i in raw_tc_order[trajectory]]
+        trajectory: spikes[raw_tc_order[trajectory]]
         for trajectory in meta.trajectories
     }
 
@@ -326,7 +321,7 @@ def cache_tuning_spikes(info, *, full_tuning_spikes, tc_order):
 @task(infos=meta_session.all_infos, cache_saves="tc_spikes")
 def cache_tc_spikes(info, *, spikes, tc_order):
     return {
-        trajectory: [spikes[i] for i in tc_order[trajectory]]
+        trajectory: spikes[tc_order[trajectory]]
         for trajectory in meta.trajectories
     }
 
@@ -532,7 +527,7 @@ def cache_matched_tuning_spikes(info, *, full_matched_tuning_spikes, matched_tc_
 @task(infos=meta_session.all_infos, cache_saves="matched_tc_spikes")
 def cache_matched_tc_spikes(info, *, spikes, matched_tc_order):
     return {
-        trajectory: [spikes[i] for i in matched_tc_order[trajectory]]
+        trajectory: spikes[matched_tc_order[trajectory]]
         for trajectory in matched_tc_order
     }
 
@@ -596,7 +591,7 @@ def cache_joined_tuning_spikes(info, *, full_joined_tuning_spikes, joined_tc_ord
 
 @task(infos=meta_session.all_infos, cache_saves="joined_tc_spikes")
 def cache_joined_tc_spikes(info, *, spikes, joined_tc_order):
-    return [spikes[i] for i in joined_tc_order]
+    return spikes[joined_tc_order]
 
 
 @task(infos=meta_session.all_infos, cache_saves="tuning_spikes_position")
@@ -0,0 +1,243 @@
+"""Content-addressed store of task results, shared between analysts.
+
+With paths.artifact_store_dir set, InfoTask and GroupTask look up each run by
+an artifact id made of the task's source, the `meta` values it reads and the
+digests of its inputs (see `artifact_id`). If the store has that artifact,
+its cache files are copied into paths.cache_dir instead of running the task.
+Otherwise the task runs and its cache entries are published to the store.
+
+Only tasks whose results are all cache entries are shared, so tasks that
+write plots always run locally.
+"""
+
+import ast
+import functools
+import hashlib
+import inspect
+import os
+import shutil
+import sqlite3
+import textwrap
+
+import cache
+import paths
+
+# Inputs up to this size are hashed whenever they are fingerprinted. Larger
+# ones (raw recordings) are hashed once, and their hash is kept in
+# paths.raw_fingerprints() by path, size and modification time.
+content_max_bytes = 2**20
+
+_fingerprints = None
+
+
+def enabled():
+    return paths.artifact_store_dir is not None
+
+
+def _in_repository(value):
+    if not inspect.isfunction(value):
+        return False
+    try:
+        source_file = inspect.getsourcefile(value)
+    except TypeError:
+        return False
+    return source_file is not None and os.path.dirname(
+        os.path.abspath(source_file)
+    ) == os.path.abspath(paths.code_dir)
+
+
+@functools.lru_cache(maxsize=None)
+def _parse(function):
+    """Source of function, the `meta` attributes it reads and the functions
+    of this repository that it refers to."""
+    source = textwrap.dedent(inspect.getsource(function))
+    meta_names = set()
+    called = []
+    try:
+        tree = ast.parse(source)
+    except SyntaxError:
+        # Lambdas, whose source is the whole line they are defined on
+        return source, meta_names, called
+    for node in ast.walk(tree):
+        value = None
+        if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name):
+            if node.value.id == "meta":
+                meta_names.add(node.attr)
+            else:
+                # Eg. plots.plot_raster
+                module = function.__globals__.get(node.value.id)
+                if inspect.ismodule(module):
+                    value = getattr(module, node.attr, None)
+        elif isinstance(node, ast.Name):
+            value = function.__globals__.get(node.id)
+        # Decorated tasks are Task objects wrapping the function
+        value = getattr(value, "function", value)
+        if _in_repository(value) and value is not function:
+            called.append(value)
+    return source, meta_names, called
+
+
+def code_dependencies(function):
+    """Source of function and of the functions of this repository that it
+    calls, directly or not, and the `meta` attributes that any of them read.
+
+    Returns
+    -------
+    sources: list of str
+    meta_names: list of str
+        Sorted.
+
+    """
+    sources = []
+    meta_names = set()
+    seen = set()
+    todo = [function]
+    while len(todo) > 0:
+        function = todo.pop()
+        if function in seen:
+            continue
+        seen.add(function)
+        source, function_meta_names, called = _parse(function)
+        sources.append(source)
+        meta_names.update(function_meta_names)
+        todo.extend(called)
+    return sources, sorted(meta_names)
+
+
+def _content_digest(path):
+    digest = hashlib.blake2b()
+    with open(path, "rb") as fileobj:
+        for chunk in iter(lambda: fileobj.read(cache.digest_chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _fingerprints_db():
+    global _fingerprints
+    if _fingerprints is None:
+        os.makedirs(paths.cache_dir, exist_ok=True)
+        _fingerprints = sqlite3.connect(paths.raw_fingerprints())
+        _fingerprints.execute(
+            "CREATE TABLE IF NOT EXISTS fingerprints"
+            " (path TEXT, size INTEGER, mtime_ns INTEGER, digest TEXT,"
+            " PRIMARY KEY (path, size, mtime_ns))"
+        )
+    return _fingerprints
+
+
+def input_fingerprint(path):
+    """Fingerprint of an input file, or None if it has no usable one."""
+    path = os.path.abspath(path)
+    if path.startswith(paths.cache_dir + os.sep):
+        # Cache entries saved before digests were recorded have none
+        return cache.read_digest(path)
+    stat = os.stat(path)
+    if stat.st_size <= content_max_bytes:
+        return _content_digest(path)
+    db = _fingerprints_db()
+    row = db.execute(
+        "SELECT digest FROM fingerprints WHERE path = ? AND size = ? AND mtime_ns = ?",
+        (path, stat.st_size, stat.st_mtime_ns),
+    ).fetchone()
+    if row is not None:
+        return row[0]
+    digest = _content_digest(path)
+    with db:
+        db.execute(
+            "INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?, ?)",
+            (path, stat.st_size, stat.st_mtime_ns, digest),
+        )
+    return digest
+
+
+def artifact_id(function, meta_values, group, keys, input_files):
+    """Id of the results of function run for group on input_files, saved
+    as the cache keys.
+
+    Returns None if an input has no fingerprint.
+    """
+    digest = hashlib.blake2b(digest_size=32)
+    sources, _ = code_dependencies(function)
+    for source in sources:
+        digest.update(source.encode())
+    for name, value in sorted(meta_values.items()):
+        digest.update(f"{name}={value}".encode())
+    digest.update(group.encode())
+    digest.update(",".join(keys).encode())
+    for path in input_files:
+        fingerprint = input_fingerprint(path)
+        if fingerprint is None:
+            return None
+        digest.update(fingerprint.encode())
+    return digest.hexdigest()
+
+
+def artifact_dir(artifact):
+    return os.path.join(paths.artifact_store_dir, artifact[:2], artifact)
+
+
+def _entry_files(directory, key):
+    if not os.path.isdir(directory):
+        return []
+    return sorted(
+        filename
+        for filename in os.listdir(directory)
+        if filename.split(".")[0] == key and not filename.endswith(".tmp")
+    )
+
+
+def _copy_order(filename):
+    # Pickles after the arrays and parts they refer to, digests last
+    return (filename.endswith(".digest"), filename.endswith(".pkl"), filename)
+
+
+def fetch(artifact, group, keys):
+    """Copies the artifact's cache entries into the cache.
+
+    Returns
+    -------
+    fetched: bool
+        False if the store doesn't have the artifact.
+
+    """
+    directory = artifact_dir(artifact)
+    if not os.path.isdir(directory):
+        return False
+    group_dir = os.path.join(paths.cache_dir, group)
+    os.makedirs(group_dir, exist_ok=True)
+    for key in keys:
+        filenames = _entry_files(directory, key)
+        for filename in sorted(filenames, key=_copy_order):
+            target = os.path.join(group_dir, filename)
+            shutil.copyfile(os.path.join(directory, filename), f"{target}.tmp")
+            os.replace(f"{target}.tmp", target)
+        # Buffers or parts of an older version of the entry
+        for filename in _entry_files(group_dir, key):
+            if filename not in filenames:
+                os.remove(os.path.join(group_dir, filename))
+        print(f"Fetched {paths.cached_file(group, key)} from {directory}")
+    return True
+
+
+def publish(artifact, group, keys):
+    """Copies the saved cache entries into the store as the artifact."""
+    directory = artifact_dir(artifact)
+    if os.path.isdir(directory):
+        return
+    cache.flush([(group, key) for key in keys])
+    tmp_dir = f"{directory}.{os.getpid()}.tmp"
+    os.makedirs(tmp_dir, exist_ok=True)
+    group_dir = os.path.join(paths.cache_dir, group)
+    for key in keys:
+        for filename in _entry_files(group_dir, key):
+            shutil.copyfile(
+                os.path.join(group_dir, filename), os.path.join(tmp_dir, filename)
+            )
+    try:
+        # Atomic, so other analysts never fetch a partial artifact
+        os.rename(tmp_dir, directory)
+    except OSError:
+        # Published by someone else in the meantime
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        return
+    print(f"Published {group} {', '.join(keys)} to {directory}")
@@ -0,0 +1,215 @@
+"""Benchmarks for slow pipeline steps, run on a full-length session.
+
+Usage: python benchmarks.py <benchmark> [session_id]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+from timeit import default_timer
+
+import numpy as np
+
+import analyze_data
+import cache
+import cache_report
+import meta_session
+import paths
+
+default_session = "R068d1"
+
+
+def get_info(session_id):
+    for info in meta_session.all_infos:
+        if info.session_id == session_id:
+            return info
+    raise ValueError(f"Session {session_id} not recognized")
+
+
+def timed(function, *args, **kwargs):
+    start = default_timer()
+    retval = function(*args, **kwargs)
+    return retval, default_timer() - start
+
+
+def decode_targets_loop(targets):
+    # Reference implementation calling extract_xy on every valid target
+    x = np.zeros(targets.shape)
+    y = np.zeros(targets.shape)
+    for sample in range(targets.shape[0]):
+        for target in range(targets.shape[1]):
+            if targets[sample, target] == 0:
+                break
+            x[sample, target], y[sample, target] = analyze_data.extract_xy(
+                int(targets[sample, target])
+            )
+    return x, y
+
+
+def benchmark_decode_targets(info):
+    nvt_data = analyze_data.load_zipped_nvt(paths.position_zip_file(info))
+    targets = nvt_data["targets"]
+
+    (loop_x, loop_y), loop_time = timed(decode_targets_loop, targets)
+    (x, y), vectorized_time = timed(analyze_data.decode_targets, targets)
+
+    assert np.array_equal(loop_x, x) and np.array_equal(loop_y, y)
+    print(f"{info.session_id}: {targets.shape[0]} samples x {targets.shape[1]} targets")
+    print(f"  extract_xy loop: {loop_time:.3f}s")
+    print(f"  decode_targets:  {vectorized_time:.3f}s")
+    print(f"  speedup:         {loop_time / vectorized_time:.1f}x")
+
+
+def remove_based_on_std_loop(original_targets, std_thresh):
+    # Reference implementation walking each problem sample in turn
+    targets = np.array(original_targets)
+    stds = np.nanstd(targets, axis=1)[:, np.newaxis]
+
+    # find idx where there is a large variation between targets
+    problem_samples = np.where(stds > std_thresh)[0]
+
+    for i in problem_samples:
+        # find the previous mean to help determine which target is an issue
+        previous_idx = i - 1
+        previous_mean = np.nanmean(targets[previous_idx])
+
+        # if previous sample is nan, compare current sample to the one before that
+        while np.isnan(previous_mean):
+            previous_idx -= 1
+            previous_mean = np.nanmean(targets[previous_idx])
+
+        # remove problem target
+        idx = np.nanargmax(np.abs(targets[i] - previous_mean))
+        targets[i][idx] = np.nan
+
+    return targets
+
+
+def synthetic_targets(n_samples, rng, n_targets=50, p_outlier=0.05):
+    # Smooth trajectory tracked by a few targets, with outliers and dropouts
+    path = np.cumsum(rng.normal(0, 0.5, n_samples)) + 100
+    n_tracked = rng.integers(0, 5, size=n_samples)
+    targets = np.full((n_samples, n_targets), np.nan)
+    for i in range(4):
+        tracked = n_tracked > i
+        targets[tracked, i] = path[tracked] + rng.normal(0, 0.5, tracked.sum())
+    outliers = rng.random(targets.shape) < p_outlier
+    targets[outliers & ~np.isnan(targets)] += rng.normal(0, 50, size=targets.shape)[
+        outliers & ~np.isnan(targets)
+    ]
+    return targets
+
+
+def benchmark_remove_based_on_std(info, n_samples=200000, seed=0):
+    # Synthetic data, so info is unused
+    rng = np.random.default_rng(seed)
+    targets = synthetic_targets(n_samples, rng)
+
+    loop_targets, loop_time = timed(remove_based_on_std_loop, targets, std_thresh=2.0)
+    vectorized_targets, vectorized_time = timed(
+        analyze_data.remove_based_on_std, targets, std_thresh=2.0
+    )
+
+    assert np.array_equal(loop_targets, vectorized_targets, equal_nan=True)
+    n_problem = np.sum(np.nanstd(targets, axis=1) > 2.0)
+    print(f"synthetic: {n_samples} samples, {n_problem} problem samples")
+    print(f"  loop:       {loop_time:.3f}s")
+    print(f"  vectorized: {vectorized_time:.3f}s")
+    print(f"  speedup:    {loop_time / vectorized_time:.1f}x")
+
+
+def benchmark_position_export(info):
+    position = cache.load(f"ind-{info.session_id}", "position")
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        csv = os.path.join(tmpdir, "position.csv")
+        mat = os.path.join(tmpdir, "position.mat")
+        _, csv_time = timed(analyze_data.save_position_csv, position, csv)
+        _, mat_time = timed(analyze_data.save_position_mat, position, mat)
+        csv_bytes = os.path.getsize(csv)
+        mat_bytes = os.path.getsize(mat)
+
+    print(f"{info.session_id}: {position.n_samples} samples")
+    print(f"  csv: {csv_time:.3f}s, {csv_bytes / 2**20:.1f} MB")
+    print(f"  mat: {mat_time:.3f}s, {mat_bytes / 2**20:.1f} MB")
+    print(
+        f"  saved {csv_time - mat_time:.3f}s and"
+        f" {(csv_bytes - mat_bytes) / 2**20:.1f} MB"
+    )
+
+
+def stored_size(group, key):
+    # All files of the entry, including the parts of partitioned entries
+    group_dir = os.path.join(paths.cache_dir, group)
+    return cache_report.entry_size(
+        os.path.join(group_dir, filename)
+        for filename in os.listdir(group_dir)
+        if filename.split(".")[0] == key
+    )
+
+
+def read_arrays(obj):
+    # Touch every array, so memory-mapped buffers are actually read
+    for array in cache._arrays(obj):
+        if array.dtype.kind in "biufc" and array.size > 0:
+            array.max()
+
+
+def benchmark_cache_codecs(info):
+    # Re-saves every cached key of the session with each codec, next to the
+    # real cache so that the drive it is on is measured
+    group = f"ind-{info.session_id}"
+    benchmark_group = f"benchmark-{info.session_id}"
+    # Parts (key.partN.pkl) are benchmarked with the entry they belong to
+    keys = sorted(
+        {
+            filename.split(".")[0]
+            for filename in os.listdir(os.path.join(paths.cache_dir, group))
+            if filename.endswith(".pkl")
+        }
+    )
+
+    print(f"{info.session_id}: {len(keys)} keys, default codec in brackets")
+    print(
+        f"  {'key':<40} {'codec':<6} {'ratio':>6} {'save MB/s':>10} {'load MB/s':>10}"
+    )
+    try:
+        for key in keys:
+            obj = cache.load(group, key)
+            chosen = cache.key_codecs.get(key, cache.choose_codec(obj))
+            for codec in ["none"] + list(cache.codecs):
+                _, save_time = timed(cache.save, benchmark_group, key, obj, codec)
+                size = stored_size(benchmark_group, key)
+                if codec == "none":
+                    raw_size = size
+                cache.clear_memo()
+                loaded, load_time = timed(cache.load, benchmark_group, key)
+                _, read_time = timed(read_arrays, loaded)
+                del loaded
+                name = f"[{codec}]" if codec == chosen else codec
+                print(
+                    f"  {key:<40} {name:<6} {raw_size / size:>6.2f}"
+                    f" {raw_size / 2**20 / save_time:>10.1f}"
+                    f" {raw_size / 2**20 / (load_time + read_time):>10.1f}"
+                )
+    finally:
+        shutil.rmtree(os.path.join(paths.cache_dir, benchmark_group))
+        cache.clear_memo()
+
+
+benchmarks = {
+    "decode_targets": benchmark_decode_targets,
+    "remove_based_on_std": benchmark_remove_based_on_std,
+    "position_export": benchmark_position_export,
+    "cache_codecs": benchmark_cache_codecs,
+}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in benchmarks:
+        print(__doc__)
+        print(f"Benchmarks: {', '.join(benchmarks)}")
+        sys.exit(1)
+    session_id = sys.argv[2] if len(sys.argv) > 2 else default_session
+    benchmarks[sys.argv[1]](get_info(session_id))
@@ -1,24 +1,561 @@
 """Helper functions for loading / saving items to paths.cache_dir"""
 
+import atexit
+import copy
+import hashlib
+import json
+import lzma
+import mmap
+import multiprocessing.util
 import os
 import pickle
+import time
+import zlib
+from collections import OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from timeit import default_timer
+
+import numpy as np
 
 import paths
+import schema
+import shared
+
+digest_chunk_size = 2**20
+
+# Bytes of cache files read by load, and of objects saved by save (before
+# compression, counted when save is called even with write_behind)
+io_bytes = {"read": 0, "written": 0}
+
+# Array buffers at least this big are pickled out-of-band (protocol 5) into
+# a sidecar file, aligned so they can be memory-mapped as arrays on load.
+out_of_band_min_bytes = 2**16
+buffer_alignment = 64
+
+# Codecs for the out-of-band buffers. Only uncompressed ("none") buffers
+# can be memory-mapped, so compression is used where it saves more reading
+# from the cache drive than it costs in decompression.
+codecs = {
+    "zlib": (lambda data: zlib.compress(data, 1), zlib.decompress),
+    # Higher presets compress spike times and positions barely better, but
+    # several times slower
+    "lzma": (lambda data: lzma.compress(data, preset=0), lzma.decompress),
+}
+lzma_max_bytes = 2**20  # Bigger payloads take too long at lzma's few MB/s
+mmap_min_bytes = 2**28
+key_codecs = {}  # Per-key codec, overriding choose_codec. Eg. {"likelihood": "zlib"}
+
+# Dicts with str keys and at least this many bytes of arrays are saved with
+# each entry in its own file, and loaded lazily as a PartitionedDict.
+partition_min_bytes = 2**20
+
+# Loaded objects are kept in memory so that tasks running one after the other
+# in the same doit worker share them instead of unpickling them again. The
+# limit is per process, so dodo.py splits its budget between the workers.
+# Only their arrays are made read-only: dicts, lists and other objects are
+# not protected, so a task that edits an input in place must copy it first
+# (eg. `dict(trials)`), or load it with copy_obj.
+memo_max_bytes = 2**30
+_memo = OrderedDict()  # (group, key): (stamp, obj, nbytes), least recent first
+_memo_bytes = 0
+
+# In write-behind mode, save() returns right away and the object is written
+# by a background thread. Use flush() to wait for writes others depend on.
+write_behind = False
+_writer = None  # (pid, ThreadPoolExecutor), as a forked process needs its own
+_pending = {}  # (group, key): (future, obj)
+
+
+def _arrays(obj, seen=None):
+    """Yields the numpy arrays reachable from containers and object attributes."""
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return
+    seen.add(id(obj))
+    if isinstance(obj, np.ndarray):
+        yield obj
+    elif isinstance(obj, dict):
+        for value in obj.values():
+            yield from _arrays(value, seen)
+    elif isinstance(obj, (list, tuple, set)):
+        for value in obj:
+            yield from _arrays(value, seen)
+    elif hasattr(obj, "__dict__"):
+        for value in vars(obj).values():
+            yield from _arrays(value, seen)
+
+
+def _is_mapped(array):
+    base = array
+    while isinstance(base, np.ndarray) and not isinstance(base, np.memmap):
+        base = base.base
+    if isinstance(base, memoryview):
+        base = base.obj
+    return isinstance(base, (np.memmap, mmap.mmap))
+
+
+def _freeze(obj):
+    """Makes all arrays in obj read-only and returns their in-memory size."""
+    nbytes = 0
+    for array in _arrays(obj):
+        array.flags.writeable = False
+        if not _is_mapped(array):
+            nbytes += array.nbytes
+    return nbytes
+
+
+def _stamp(cached_file):
+    stat = os.stat(cached_file)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _memo_put(group, key, stamp, obj):
+    global _memo_bytes
+    _memo_discard(group, key)
+    nbytes = _freeze(obj)
+    if nbytes > memo_max_bytes:
+        return
+    while _memo and _memo_bytes + nbytes > memo_max_bytes:
+        _, (_, _, evicted_nbytes) = _memo.popitem(last=False)
+        _memo_bytes -= evicted_nbytes
+    _memo[group, key] = (stamp, obj, nbytes)
+    _memo_bytes += nbytes
+
+
+def _memo_discard(group, key):
+    global _memo_bytes
+    if (group, key) in _memo:
+        _, _, nbytes = _memo.pop((group, key))
+        _memo_bytes -= nbytes
+
+
+def clear_memo():
+    global _memo_bytes
+    _memo.clear()
+    _memo_bytes = 0
+
+
+def _discard_released():
+    # Memoized objects in released shared memory would keep it mapped, and
+    # count for nothing against memo_max_bytes
+    groups = shared.released_groups()
+    for memo_group, memo_key in [key for key in _memo if key[0] in groups]:
+        _memo_discard(memo_group, memo_key)
+    shared.close_released()
+
 
+def load(group, key, copy_obj=False):
+    """Loads a cached object.
 
-def load(group, key):
+    Parameters
+    ----------
+    group: str
+    key: str
+    copy_obj: bool
+        Return a private, writeable copy instead of the shared object, whose
+        arrays are read-only and which later loads in this process return.
+
+    """
+    flush([(group, key)])
+    if shared.enabled:
+        _discard_released()
     cached_file = paths.cached_file(group, key)
     assert os.path.exists(
         cached_file
     ), f"'{cached_file}' does not exist. Cache it first."
 
-    with open(cached_file, "rb") as fileobj:
-        return pickle.load(fileobj)
+    stamp = _stamp(cached_file)
+    if (group, key) in _memo and _memo[group, key][0] == stamp:
+        _memo.move_to_end((group, key))
+        obj = _memo[group, key][1]
+    else:
+        obj = _read(group, key, key)
+        _memo_put(group, key, stamp, obj)
+    return copy.deepcopy(obj) if copy_obj else obj
+
+
+def _read(group, blob_key, key):
+    """Unpickles a blob of key, through shared memory if key is shared."""
+    shareable = shared.enabled and key in shared.shared_keys
+    stamp = _stamp(paths.cached_file(group, blob_key))
+    obj = shared.attach(group, blob_key, stamp) if shareable else None
+    if obj is None:
+        start = default_timer()
+        obj = _load_pickle(group, blob_key)
+        _record_load(group, key, default_timer() - start)
+        io_bytes["read"] += os.path.getsize(paths.cached_file(group, blob_key))
+        if os.path.exists(paths.cached_buffers(group, blob_key)):
+            io_bytes["read"] += os.path.getsize(paths.cached_buffers(group, blob_key))
+        if shareable and not isinstance(obj, PartitionedDict):
+            obj = shared.publish(group, blob_key, stamp, obj)
+    return obj
+
+
+def _record_load(group, key, duration):
+    # One short line per append, so concurrent workers don't interleave
+    line = json.dumps({"group": group, "key": key, "time": time.time(), "s": duration})
+    with open(paths.cache_load_stats(), "a") as fileobj:
+        fileobj.write(f"{line}\n")
+
+
+def read_load_stats():
+    """Last read time and load durations of each (group, key) read from disk.
+
+    Returns
+    -------
+    stats: dict
+        With (group, key) as keys and (last_read, [durations]) as values.
+
+    """
+    stats = {}
+    if not os.path.exists(paths.cache_load_stats()):
+        return stats
+    with open(paths.cache_load_stats(), "r") as fileobj:
+        for line in fileobj:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # Partially written by a killed worker
+            last_read, durations = stats.get((record["group"], record["key"]), (0, []))
+            durations.append(record["s"])
+            stats[record["group"], record["key"]] = (
+                max(last_read, record["time"]),
+                durations,
+            )
+    return stats
+
+
+class PartitionedDict(Mapping):
+    """Read-only dict of a partitioned cache entry, loading entries on access."""
+
+    def __init__(self, group, key, subkeys):
+        self.group = group
+        self.key = key
+        self.subkeys = list(subkeys)
+        self._loaded = {}
+
+    def __getitem__(self, subkey):
+        if subkey not in self._loaded:
+            part = self.subkeys.index(subkey) if subkey in self.subkeys else None
+            if part is None:
+                raise KeyError(subkey)
+            value = _read(self.group, _part_key(self.key, part), self.key)
+            _freeze(value)
+            self._loaded[subkey] = value
+        return self._loaded[subkey]
+
+    def __iter__(self):
+        return iter(self.subkeys)
+
+    def __len__(self):
+        return len(self.subkeys)
+
+    def __repr__(self):
+        return f"PartitionedDict({self.group}, {self.key}, {self.subkeys})"
+
+    def __deepcopy__(self, memo):
+        return {subkey: copy.deepcopy(self[subkey], memo) for subkey in self}
+
+    def __reduce__(self):
+        # Saved again (eg. as part of a task's output) as a plain dict
+        return dict, (dict(self.items()),)
+
+
+def _part_key(key, part):
+    return f"{key}.part{part}"
+
+
+def _load_pickle(group, key):
+    with open(paths.cached_file(group, key), "rb") as fileobj:
+        header = pickle.load(fileobj)
+        if not (isinstance(header, dict) and "out_of_band_buffers" in header):
+            # Saved without out-of-band buffers
+            return header
+        if "partitions" in header:
+            return PartitionedDict(group, key, header["partitions"])
+
+        index = header["out_of_band_buffers"]
+        codec = header.get("codec", "none")
+        buffers = []
+        if len(index) > 0 and codec == "none":
+            with open(paths.cached_buffers(group, key), "rb") as buffers_file:
+                mapped = mmap.mmap(buffers_file.fileno(), 0, access=mmap.ACCESS_READ)
+            buffers = [
+                memoryview(mapped)[offset : offset + nbytes] for offset, nbytes in index
+            ]
+        elif len(index) > 0:
+            _, decompress = codecs[codec]
+            with open(paths.cached_buffers(group, key), "rb") as buffers_file:
+                for offset, nbytes in index:
+                    buffers_file.seek(offset)
+                    buffers.append(decompress(buffers_file.read(nbytes)))
+        return pickle.load(fileobj, buffers=buffers)
+
 
+def choose_codec(obj):
+    """Picks a codec for obj from the dtypes and sizes of its arrays.
 
-def save(group, key, obj):
+    Small payloads are compressed densely with lzma. Mostly-float payloads
+    (likelihoods, LFP) too big for that stay uncompressed past mmap_min_bytes
+    so they can be memory-mapped, and everything else uses fast zlib.
+    """
+    if hasattr(obj, "save_arrays"):
+        return "none"
+    nbytes_bykind = {}
+    for array in _arrays(obj):
+        if not _is_mapped(array):
+            kind = array.dtype.kind
+            nbytes_bykind[kind] = nbytes_bykind.get(kind, 0) + array.nbytes
+    nbytes = sum(nbytes_bykind.values())
+    float_nbytes = nbytes_bykind.get("f", 0) + nbytes_bykind.get("c", 0)
+
+    if nbytes < out_of_band_min_bytes:
+        return "none"  # All in-band
+    elif nbytes <= lzma_max_bytes:
+        return "lzma"
+    elif float_nbytes > nbytes / 2 and nbytes >= mmap_min_bytes:
+        return "none"
+    return "zlib"
+
+
+def _partitioned(obj):
+    if type(obj) is not dict or len(obj) < 2:
+        return False
+    if not all(isinstance(subkey, str) for subkey in obj):
+        return False
+    return sum(array.nbytes for array in _arrays(obj)) >= partition_min_bytes
+
+
+class _HashingWriter:
+    """File wrapper that hashes everything written through it."""
+
+    def __init__(self, fileobj, digest):
+        self.fileobj = fileobj
+        self.digest = digest
+
+    def write(self, data):
+        self.digest.update(data)
+        return self.fileobj.write(data)
+
+
+def digest_path(cached_file):
+    return f"{cached_file}.digest"
+
+
+def read_digest(cached_file):
+    """Content digest recorded by `save`, or None if there is none."""
+    try:
+        with open(digest_path(cached_file), "r") as fileobj:
+            return fileobj.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def _update_digest_from_file(digest, path):
+    with open(path, "rb") as fileobj:
+        for chunk in iter(lambda: fileobj.read(digest_chunk_size), b""):
+            digest.update(chunk)
+
+
+def _serialize(obj):
+    """obj's pickle and the buffers to write out-of-band, for `_dump`."""
+    buffers = []
+
+    def out_of_band(buffer):
+        # Returning True keeps the buffer in-band
+        if buffer.raw().nbytes < out_of_band_min_bytes:
+            return True
+        buffers.append(buffer)
+        return False
+
+    return schema.dumps(obj, buffer_callback=out_of_band), buffers
+
+
+def _serialize_entry(obj):
+    """Serialized entries of a partitioned dict, or of obj as a whole.
+
+    Returns None for columnar stores, which can only be pickled once
+    `_write` has saved their arrays.
+    """
+    if hasattr(obj, "save_arrays"):
+        return None
+    if _partitioned(obj):
+        return [_serialize(value) for value in obj.values()]
+    return [_serialize(obj)]
+
+
+def _serialized_bytes(obj, serialized):
+    if serialized is None:
+        return sum(getattr(obj, name).nbytes for name in obj.arrays)
+    return sum(
+        len(data) + sum(buffer.raw().nbytes for buffer in buffers)
+        for data, buffers in serialized
+    )
+
+
+def _dump(group, key, serialized, codec, digest, header=None):
+    """Writes a pickle from `_serialize` and its out-of-band buffers,
+    updating digest."""
+    data, buffers = serialized
+    index = []
+    buffers_file = paths.cached_buffers(group, key)
+    if len(buffers) == 0 and os.path.exists(buffers_file):
+        os.remove(buffers_file)
+    elif len(buffers) > 0:
+        # Write to a new file, as other processes may have the old one mapped
+        with open(f"{buffers_file}.tmp", "wb") as fileobj:
+            writer = _HashingWriter(fileobj, digest)
+            offset = 0
+            for buffer in buffers:
+                if codec == "none":
+                    padding = -offset % buffer_alignment
+                    writer.write(b"\0" * padding)
+                    offset += padding
+                    stored = buffer.raw()
+                else:
+                    compress, _ = codecs[codec]
+                    stored = compress(buffer.raw())
+                writer.write(stored)
+                index.append((offset, len(stored)))
+                offset += len(stored)
+        os.replace(f"{buffers_file}.tmp", buffers_file)
+
+    header = {} if header is None else dict(header)
+    header.update({"out_of_band_buffers": index, "codec": codec})
     cached_file = paths.cached_file(group, key)
-    os.makedirs(os.path.dirname(cached_file), exist_ok=True)
-    with open(cached_file, "wb") as fileobj:
-        pickle.dump(obj, fileobj)
+    with open(f"{cached_file}.tmp", "wb") as fileobj:
+        writer = _HashingWriter(fileobj, digest)
+        pickle.dump(header, writer)
+        writer.write(data)
+    # Atomic, so a crash never leaves a truncated pickle behind
+    os.replace(f"{cached_file}.tmp", cached_file)
+
+
+def _remove_parts(group, key, first_part):
+    part = first_part
+    while os.path.exists(paths.cached_file(group, _part_key(key, part))):
+        for path in [
+            paths.cached_file(group, _part_key(key, part)),
+            paths.cached_buffers(group, _part_key(key, part)),
+        ]:
+            if os.path.exists(path):
+                os.remove(path)
+        part += 1
+
+
+def _write(group, key, obj, codec, serialized):
+    cached_file = paths.cached_file(group, key)
+    digest = hashlib.blake2b()
+    if hasattr(obj, "save_arrays"):
+        # Columnar stores (see stores.py) write their arrays beside the pickle.
+        # If interrupted, the old pickle would point at a mix of old and new
+        # arrays, so remove it for the entry to be out of date.
+        if os.path.exists(cached_file):
+            os.remove(cached_file)
+        obj.save_arrays(group, key)
+        for name in obj.arrays:
+            _update_digest_from_file(digest, paths.cached_array(group, key, name))
+        serialized = [_serialize(obj)]
+
+    if _partitioned(obj):
+        for part, value in enumerate(obj.values()):
+            part_codec = choose_codec(value) if codec is None else codec
+            _dump(group, _part_key(key, part), serialized[part], part_codec, digest)
+        _remove_parts(group, key, first_part=len(obj))
+        # The manifest is written last, so the parts it lists are complete
+        header = {"partitions": list(obj)}
+        _dump(group, key, _serialize(None), "none", digest, header=header)
+    else:
+        _remove_parts(group, key, first_part=0)
+        codec = choose_codec(obj) if codec is None else codec
+        _dump(group, key, serialized[0], codec, digest)
+
+    with open(f"{digest_path(cached_file)}.tmp", "w") as fileobj:
+        fileobj.write(digest.hexdigest())
+    os.replace(f"{digest_path(cached_file)}.tmp", digest_path(cached_file))
     print("Saved {}".format(cached_file))
+
+
+def _executor():
+    global _writer
+    if _writer is None or _writer[0] != os.getpid():
+        _writer = (os.getpid(), ThreadPoolExecutor(max_workers=1))
+        _pending.clear()
+        # doit workers exit without running atexit, but do run these finalizers
+        atexit.register(flush)
+        multiprocessing.util.Finalize(None, flush, exitpriority=100)
+    return _writer[1]
+
+
+def flush(group_keys=None):
+    """Waits for write-behind saves to finish.
+
+    Parameters
+    ----------
+    group_keys: list of (group, key) tuples or None
+        Only wait for these saves. If None, waits for all of them.
+
+    """
+    if group_keys is None:
+        group_keys = list(_pending)
+    errors = []
+    for group, key in group_keys:
+        if (group, key) not in _pending:
+            continue
+        future, obj = _pending.pop((group, key))
+        try:
+            future.result()
+        except Exception as exception:
+            errors.append(exception)
+        else:
+            _memo_put(group, key, _stamp(paths.cached_file(group, key)), obj)
+    if errors:
+        raise errors[0]
+
+
+def save(group, key, obj, codec=None):
+    """Saves obj to the cache.
+
+    Parameters
+    ----------
+    group: str
+    key: str
+    obj: object
+    codec: str or None
+        One of "none" or the keys of `codecs`. If None, uses key_codecs[key]
+        or else choose_codec on obj (or each entry of a partitioned dict).
+
+    """
+    if codec is None and key in key_codecs:
+        codec = key_codecs[key]
+    assert codec in [None, "none"] or codec in codecs, f"Unknown codec '{codec}'"
+
+    cached_file = paths.cached_file(group, key)
+    os.makedirs(os.path.dirname(cached_file), exist_ok=True)
+    flush([(group, key)])
+    _memo_discard(group, key)
+
+    # Remove the old digest first, so an interrupted save is never up to date
+    if os.path.exists(digest_path(cached_file)):
+        os.remove(digest_path(cached_file))
+
+    # Pickled here, so that the bytes saved count towards the running task
+    serialized = _serialize_entry(obj)
+    io_bytes["written"] += _serialized_bytes(obj, serialized)
+
+    if write_behind:
+        # A failed write may only be raised after doit has recorded the task
+        # as done, so remove the old target for the task to be out of date
+        if os.path.exists(cached_file):
+            os.remove(cached_file)
+        # Read-only, so the task cannot change obj while it is being written
+        _freeze(obj)
+        _pending[group, key] = (
+            _executor().submit(_write, group, key, obj, codec, serialized),
+            obj,
+        )
+    else:
+        _write(group, key, obj, codec, serialized)
+        # Dependent tasks often run next in the same worker
+        _memo_put(group, key, _stamp(cached_file), obj)
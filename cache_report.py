@@ -0,0 +1,204 @@
+"""Inventory of paths.cache_dir: size, reads and producing task of each key.
+
+`doit cache_report` prints the inventory. `doit cache_report --gc` also
+removes orphans (cached keys that no task saves any more, and files left
+behind by interrupted writes), and `--quota GB` evicts the least recently
+read entries of at least `evict_min_bytes` until the cache fits the quota.
+Evicted entries are recomputed by doit when next needed.
+"""
+
+import os
+import time
+
+import numpy as np
+
+import cache
+import manifest
+import paths
+from tasks import GroupTask, InfoTask, Task
+
+GB = 2**30
+evict_min_bytes = 2**20
+
+
+def produced_entries():
+    """Maps each (group, key) that a task saves to the name of that task."""
+    manifest.import_all()
+    produced = {}
+    for task in Task.all_tasks:
+        if isinstance(task, InfoTask):
+            groups = [f"ind-{info.session_id}" for info in task.infos]
+        elif isinstance(task, GroupTask):
+            groups = [f"grp-{group_name}" for group_name in task.groups]
+        else:
+            continue
+        for group in groups:
+            for key in task.cache_saves:
+                produced[group, key] = task.function.__name__
+    return produced
+
+
+def cache_entries():
+    """Files in the cache, grouped by the (group, key) they belong to.
+
+    All files of a key are named `{key}.*` (pickle, digest, buffers, parts,
+    arrays). Files not named after a key, like the position exports, are
+    not managed by the cache and are left out.
+
+    Returns
+    -------
+    entries: dict
+        With (group, key) as keys and lists of paths as values.
+
+    """
+    entries = {}
+    if not os.path.isdir(paths.cache_dir):
+        return entries
+    for group in sorted(os.listdir(paths.cache_dir)):
+        group_dir = os.path.join(paths.cache_dir, group)
+        if not os.path.isdir(group_dir):
+            continue
+        for filename in os.listdir(group_dir):
+            key = filename.split(".")[0]
+            if key.isidentifier():
+                entries.setdefault((group, key), []).append(
+                    os.path.join(group_dir, filename)
+                )
+    return entries
+
+
+def entry_size(files):
+    return sum(os.path.getsize(path) for path in files if os.path.exists(path))
+
+
+def remove_entry(files):
+    for path in files:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def format_bytes(nbytes):
+    for unit in ["B", "KB", "MB", "GB"]:
+        if nbytes < 1024 or unit == "GB":
+            return f"{nbytes:.1f} {unit}" if unit != "B" else f"{nbytes} B"
+        nbytes /= 1024
+
+
+def format_time(timestamp):
+    if timestamp is None:
+        return "never"
+    return time.strftime("%Y-%m-%d %H:%M", time.localtime(timestamp))
+
+
+def print_report(entries, produced, stats):
+    # Summarized per key, over all groups
+    bykey = {}
+    for (group, key), files in entries.items():
+        task_name = produced.get((group, key), "orphan")
+        size, last_read, durations, n_groups = bykey.get(
+            (key, task_name), (0, None, [], 0)
+        )
+        entry_last_read, entry_durations = stats.get((group, key), (None, []))
+        if entry_last_read is not None:
+            last_read = max(last_read or 0, entry_last_read)
+        bykey[key, task_name] = (
+            size + entry_size(files),
+            last_read,
+            durations + entry_durations,
+            n_groups + 1,
+        )
+
+    total = sum(size for size, _, _, _ in bykey.values())
+    print(f"{paths.cache_dir}: {len(entries)} entries, {format_bytes(total)}")
+    print(
+        f"{'key':<40} {'task':<40} {'groups':>6} {'size':>10}"
+        f" {'last read':>16} {'median load':>11}"
+    )
+    for (key, task_name), (size, last_read, durations, n_groups) in sorted(
+        bykey.items(), key=lambda item: -item[1][0]
+    ):
+        median_load = f"{np.median(durations):.3f}s" if durations else "-"
+        print(
+            f"{key:<40} {task_name:<40} {n_groups:>6} {format_bytes(size):>10}"
+            f" {format_time(last_read):>16} {median_load:>11}"
+        )
+
+
+def collect_garbage(entries, produced, stats, remove_orphans=True, quota=None):
+    """Removes orphan entries and temp files, then evicts down to quota bytes."""
+    removed = 0
+    for (group, key), files in list(entries.items()):
+        if (group, key) not in produced:
+            if not remove_orphans:
+                continue
+            removed += entry_size(files)
+            remove_entry(files)
+            del entries[group, key]
+            print(f"Removed orphan {group}/{key}")
+        else:
+            leftovers = [path for path in files if path.endswith(".tmp")]
+            removed += entry_size(leftovers)
+            remove_entry(leftovers)
+            entries[group, key] = [path for path in files if path not in leftovers]
+            if len(entries[group, key]) == 0:
+                del entries[group, key]
+
+    if quota is not None:
+        sizes = {group_key: entry_size(files) for group_key, files in entries.items()}
+        total = sum(sizes.values())
+        evictable = sorted(
+            (group_key for group_key in entries if sizes[group_key] >= evict_min_bytes),
+            key=lambda group_key: stats.get(group_key, (0, []))[0],
+        )
+        for group, key in evictable:
+            if total <= quota:
+                break
+            remove_entry(entries.pop((group, key)))
+            total -= sizes[group, key]
+            removed += sizes[group, key]
+            print(f"Evicted {group}/{key} ({format_bytes(sizes[group, key])})")
+
+    print(f"Freed {format_bytes(removed)}")
+
+
+def cache_report(gc, quota):
+    entries = cache_entries()
+    produced = produced_entries()
+    stats = cache.read_load_stats()
+    if gc or quota > 0:
+        collect_garbage(
+            entries,
+            produced,
+            stats,
+            remove_orphans=gc,
+            quota=quota * GB if quota > 0 else None,
+        )
+    print_report(entries, produced, stats)
+
+
+def task_cache_report():
+    return {
+        "actions": [(cache_report,)],
+        "params": [
+            {
+                "name": "gc",
+                "long": "gc",
+                "type": bool,
+                "default": False,
+                "help": "Remove orphaned cache entries",
+            },
+            {
+                "name": "quota",
+                "long": "quota",
+                "type": float,
+                "default": 0,
+                "help": "Evict least recently read entries down to this many GB",
+            },
+        ],
+        "uptodate": [False],
+        "verbosity": 2,
+    }
+
+
+# Only run when asked for by name
+task_cache_report.on_demand = True
@@ -1,18 +1,35 @@
 import os
 import sys
+from collections import Counter
 from importlib import import_module
 from timeit import default_timer
 
 import doit
 import matplotlib
+from doit.dependency import FileChangedChecker
 from doit.reporter import ConsoleReporter
 
-from tasks import Task
+import cache
+import manifest
+import paths
+import shared
+import tasks
+import timings
 
 if sys.platform == "linux":
     os.environ["R_LIBS_SITE"] = "/usr/lib/R/site-library"
 
 matplotlib.use("Agg")
+num_process = 6 if sys.platform == "linux" else 3
+# The memo is per process, so split its budget between the workers
+cache.memo_max_bytes = 2 * 2**30 // num_process
+cache.write_behind = True
+shared.enabled = True
+shared.run_id = str(os.getpid())
+# `doit fuse_sessions=1` runs all InfoTasks of a session as one task
+fuse_sessions = doit.get_var("fuse_sessions") == "1"
+# Rebuilt (importing all task modules) only when the sources have changed
+task_manifest = manifest.load(fuse_sessions)
 
 
 class Timer:
@@ -30,10 +47,50 @@ class Timer:
             self._start = None
 
 
+def full_name(described):
+    if described["name"] is None:
+        return described["basename"]
+    return f"{described['basename']}:{described['name']}"
+
+
 class TimedConsoleReporter(ConsoleReporter):
     def __init__(self, outstream, options):
         super().__init__(outstream, options)
         self.timers = {}
+        # Shared memory for a session is released when no scheduled task
+        # reads it any more. Counted in initialize, as only the selected
+        # tasks and their dependencies ever finish.
+        self.reads = {
+            full_name(described): described["reads"]
+            for described in task_manifest["tasks"]
+            if len(described["reads"]) > 0
+        }
+        self.references = {}
+        self.reference_counts = Counter()
+        self.timings_db = timings.connect()
+        self.revision = timings.git_revision()
+
+    def initialize(self, tasks, selected_tasks):
+        scheduled = set()
+        todo = list(selected_tasks)
+        while len(todo) > 0:
+            name = todo.pop()
+            if name in scheduled or name not in tasks:
+                continue
+            scheduled.add(name)
+            # Including the implicit dependencies on the producers of file_dep
+            todo.extend(tasks[name].task_dep)
+            todo.extend(tasks[name].setup_tasks)
+        for name in scheduled:
+            self.references[name] = self.reads.get(name, [])
+            self.reference_counts.update(self.references[name])
+        super().initialize(tasks, selected_tasks)
+
+    def _release(self, task):
+        for group in self.references.pop(task.name, []):
+            self.reference_counts[group] -= 1
+            if self.reference_counts[group] == 0:
+                shared.release(group)
 
     def get_status(self, task):
         self.timers[task.name] = Timer(task)
@@ -45,17 +102,81 @@ class TimedConsoleReporter(ConsoleReporter):
     def add_failure(self, task, exception):
         self.timers[task.name].finish()
         self.write("X  %.3fs %s\n" % (self.timers[task.name].duration, task.title()))
+        self._release(task)
         super().add_failure(task, exception)
 
     def add_success(self, task):
         self.timers[task.name].finish()
         self.write("O  %.3fs %s\n" % (self.timers[task.name].duration, task.title()))
+        timings.record(
+            self.timings_db,
+            task.name,
+            self.timers[task.name].duration,
+            values=task.values,
+            revision=self.revision,
+        )
+        self._release(task)
         super().add_success(task)
 
+    def skip_uptodate(self, task):
+        self._release(task)
+        super().skip_uptodate(task)
+
+    def skip_ignore(self, task):
+        self._release(task)
+        super().skip_ignore(task)
+
+    def complete_run(self):
+        # On-demand tasks that were not selected never reach get_status
+        skipped = [
+            raw_input
+            for name, raw_input in task_manifest["on_demand_inputs"]
+            if name not in self.timers
+        ]
+        if skipped:
+            self.write(
+                f"Skipped {len(skipped)} raw inputs not needed by any selected task:\n"
+            )
+            for raw_input in skipped:
+                self.write(f"   {raw_input}\n")
+        # Including the segments of sessions with unselected tasks
+        shared.release_all()
+        super().complete_run()
+
+
+class DigestChecker(FileChangedChecker):
+    """Checks cached files by the content digest written by cache.save.
+
+    A task that reruns but saves byte-identical output does not make its
+    dependents out of date. Files without a digest are checked by timestamp,
+    as are states saved by doit's timestamp checker, which this replaces.
+    """
+
+    def check_modified(self, file_path, file_stat, state):
+        if not isinstance(state, (list, tuple)):
+            # Recorded by the timestamp checker
+            return file_stat.st_mtime != state
+        timestamp, digest = state
+        if file_stat.st_mtime == timestamp:
+            return False
+        return digest is None or cache.read_digest(file_path) != digest
+
+    def get_state(self, dep, current_state):
+        timestamp = os.path.getmtime(dep)
+        if isinstance(current_state, (list, tuple)) and current_state[0] == timestamp:
+            return None
+        return timestamp, cache.read_digest(dep)
+
+
+# doit saves the name of the checker with each task, and drops all saved
+# state of tasks saved by a checker of another name, which would rerun the
+# whole pipeline once. Under the timestamp checker's name, its states are
+# reused as they are.
+DigestChecker.__name__ = "TimestampChecker"
 
 DOIT_CONFIG = {
-    "check_file_uptodate": "timestamp",
-    "num_process": 6 if sys.platform == "linux" else 3,
+    "check_file_uptodate": DigestChecker,
+    "num_process": num_process,
     "reporter": TimedConsoleReporter,
     "verbosity": 2,
 }
@@ -65,27 +186,53 @@ def find_tasks(module_name):
     module = import_module(module_name)
     for name in dir(module):
         obj = getattr(module, name)
-        if isinstance(obj, Task) or name.startswith("task_"):
+        if name.startswith("task_"):
             globals()[name] = obj
 
 
-find_tasks("analyze_data")
-find_tasks("plot_data")
-find_tasks("analyze_decoding")
-find_tasks("plot_decoding")
-find_tasks("analyze_linear")
-find_tasks("plot_linear")
-find_tasks("analyze_position")
-find_tasks("plot_position")
-find_tasks("analyze_replays")
-find_tasks("plot_replays")
-find_tasks("analyze_swrs")
-find_tasks("plot_swrs")
-find_tasks("analyze_trials")
-find_tasks("plot_trials")
-find_tasks("analyze_tuning_curves")
-find_tasks("plot_tuning_curves")
-find_tasks("combine")  # make sure this is loaded last
+find_tasks("cache_report")
+find_tasks("timings")
+# combine's task creators use the files listed while creating the other tasks
+tasks.Task.tex_files[:] = task_manifest["tex_files"]
+tasks.FigureTask.figure_files[:] = task_manifest["figure_files"]
+find_tasks("combine")
+
+# Start the longest chains of tasks first, by their durations in past runs
+priorities = {}
+if os.path.exists(paths.task_timings()):
+    priorities = timings.chain_lengths(
+        [
+            dict(described, name=full_name(described))
+            for described in task_manifest["tasks"]
+        ],
+        timings.estimates(),
+    )
+
+# The analysis modules are only imported by the tasks that run
+bybasename = {}
+for described in sorted(
+    task_manifest["tasks"],
+    key=lambda described: -priorities.get(full_name(described), 0),
+):
+    bybasename.setdefault(described["basename"], []).append(described)
+for basename, described_tasks in bybasename.items():
+    globals()[basename] = manifest.ManifestTask(described_tasks)
+
+
+def default_tasks():
+    """All tasks except on-demand ones, which run only when another task needs them."""
+    names = [
+        basename
+        for basename, described_tasks in bybasename.items()
+        if not all(described["on_demand"] for described in described_tasks)
+    ]
+    for name, obj in globals().items():
+        if name.startswith("task_") and not getattr(obj, "on_demand", False):
+            names.append(name[len("task_") :])
+    return names
+
+
+DOIT_CONFIG["default_tasks"] = default_tasks()
 
 
 if __name__ == "__main__":
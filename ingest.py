@@ -0,0 +1,178 @@
+"""Parallel ingestion of raw data for all sessions.
+
+Runs the raw-ingest tasks from analyze_data for every session in a process
+pool, with I/O-bound loaders and CPU-bound steps in separate pools. Jobs are
+only started while their estimated peak memory fits in the memory budget, so
+two huge LFP loads never run at the same time. On-demand tasks (eg. the
+lfp_theta channel) are only run if another ingest task depends on them.
+
+Usage: python ingest.py [--io-workers N] [--cpu-workers N] [--memory-budget GB]
+
+Afterwards, run `doit reset-dep` so that doit records the cached files as
+up to date instead of re-ingesting them.
+"""
+
+import argparse
+import os
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from timeit import default_timer
+
+import analyze_data
+import meta_session
+import paths
+
+GB = 2**30
+
+
+def file_size(path):
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+def zipped_size(path):
+    if not os.path.exists(path):
+        return 0
+    with zipfile.ZipFile(path, "r") as file:
+        return sum(zinfo.file_size for zinfo in file.infolist())
+
+
+# Task name: (pool, estimated peak memory in bytes for a session)
+# LFP is stored as int16 on disk but loaded as float64 data + float64 time,
+# with an intermediate copy, so peak memory is roughly 12x the .ncs size.
+ingest_tasks = {
+    "cache_events": ("io", lambda info: 10 * file_size(paths.event_file(info))),
+    "cache_lfp_swr": ("io", lambda info: 12 * file_size(paths.lfp_swr_file(info))),
+    "cache_lfp_theta": (
+        "io",
+        lambda info: 12 * file_size(paths.lfp_theta_file(info)),
+    ),
+    "cache_task_times": ("cpu", lambda info: 0),
+    "cache_spikes": ("io", lambda info: 0),
+    "cache_position": (
+        "cpu",
+        lambda info: 3 * zipped_size(paths.position_zip_file(info)),
+    ),
+}
+
+
+def default_memory_budget():
+    if hasattr(os, "sysconf"):
+        return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") // 2
+    return 8 * GB
+
+
+def task_dependencies(module):
+    """Maps each ingest task to the ingest tasks producing its cache loads."""
+    produced_by = {}
+    for name in ingest_tasks:
+        for key in getattr(module, name).cache_saves:
+            produced_by[key] = name
+    return {
+        name: [
+            produced_by[key]
+            for key in getattr(module, name).cache_loads
+            if key in produced_by
+        ]
+        for name in ingest_tasks
+    }
+
+
+def selected_tasks(dependencies):
+    """Ingest tasks that are not on-demand, plus the tasks they depend on."""
+    selected = [
+        name for name in ingest_tasks if not getattr(analyze_data, name).on_demand
+    ]
+    for name in selected:
+        selected.extend(dep for dep in dependencies[name] if dep not in selected)
+    return selected
+
+
+def run_task(task_name, session_id):
+    """Runs one InfoTask for one session. Executed in a worker process."""
+    task = getattr(analyze_data, task_name)
+    (info,) = [info for info in task.infos if info.session_id == session_id]
+    start = default_timer()
+    task(info)
+    return default_timer() - start
+
+
+def ingest(infos, io_workers, cpu_workers, memory_budget):
+    dependencies = task_dependencies(analyze_data)
+    pending = {
+        (name, info.session_id): info
+        for info in infos
+        for name in selected_tasks(dependencies)
+    }
+    done = set()
+    failed = set()
+    running = {}
+    reserved = 0
+
+    def ready(name, info):
+        return all((dep, info.session_id) in done for dep in dependencies[name])
+
+    def blocked(name, info):
+        return any((dep, info.session_id) in failed for dep in dependencies[name])
+
+    with ProcessPoolExecutor(io_workers) as io_pool, ProcessPoolExecutor(
+        cpu_workers
+    ) as cpu_pool:
+        pools = {"io": io_pool, "cpu": cpu_pool}
+
+        while pending or running:
+            for (name, session_id), info in list(pending.items()):
+                if blocked(name, info):
+                    del pending[name, session_id]
+                    failed.add((name, session_id))
+                    print(f"Skipped {name}:{info.session_id}, a dependency failed")
+                    continue
+                if not ready(name, info):
+                    continue
+                pool, estimate_memory = ingest_tasks[name]
+                memory = estimate_memory(info)
+                # Always allow one job to run, even if it is over budget
+                if running and reserved + memory > memory_budget:
+                    continue
+                future = pools[pool].submit(run_task, name, info.session_id)
+                running[future] = (name, info, memory)
+                reserved += memory
+                del pending[name, session_id]
+
+            assert running, "Ingest tasks have unsatisfiable dependencies"
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name, info, memory = running.pop(future)
+                reserved -= memory
+                try:
+                    duration = future.result()
+                except Exception as exception:
+                    failed.add((name, info.session_id))
+                    print(f"X  {name}:{info.session_id} failed: {exception!r}")
+                else:
+                    done.add((name, info.session_id))
+                    print(f"O  {duration:.3f}s {name}:{info.session_id}")
+
+    return failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--io-workers", type=int, default=2)
+    parser.add_argument("--cpu-workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument(
+        "--memory-budget",
+        type=float,
+        default=default_memory_budget() / GB,
+        help="GB of memory that running jobs may use",
+    )
+    args = parser.parse_args()
+
+    failed = ingest(
+        meta_session.all_infos,
+        io_workers=args.io_workers,
+        cpu_workers=args.cpu_workers,
+        memory_budget=args.memory_budget * GB,
+    )
+    if failed:
+        raise SystemExit(f"{len(failed)} ingest tasks failed or were skipped")
+    print("Run `doit reset-dep` so doit records the ingested files as up to date")
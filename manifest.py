@@ -0,0 +1,293 @@
+"""Manifest of the doit tasks, so dodo.py starts without importing the analyses.
+
+Importing all of `task_modules` takes seconds (nept, statsmodels, shapely,
+all the session infos...), even for `doit list` or rerunning one task.
+`build` imports them once and records each doit task's module, dependencies
+and targets in paths.task_manifest(). While no source file or session info
+has changed since, dodo.py creates the doit tasks from the manifest with
+`run` as their action, which only imports a task's module when it runs.
+
+The manifest also records a digest of the `meta` values each task reads
+(see Task.meta_values), so that changing one in meta.py only reruns the
+tasks that read it, and the tasks depending on their results.
+"""
+
+import glob
+import hashlib
+import json
+import os
+import sqlite3
+from importlib import import_module
+
+import paths
+from tasks import FigureTask, GroupTask, InfoTask, SessionTask, Task
+
+task_modules = [
+    "analyze_data",
+    "plot_data",
+    "analyze_decoding",
+    "plot_decoding",
+    "analyze_linear",
+    "plot_linear",
+    "analyze_position",
+    "plot_position",
+    "analyze_replays",
+    "plot_replays",
+    "analyze_swrs",
+    "plot_swrs",
+    "analyze_trials",
+    "plot_trials",
+    "analyze_tuning_curves",
+    "plot_tuning_curves",
+    "combine",  # make sure this is loaded last
+]
+
+_session_task = None
+_meta_baselines = None
+
+
+def import_all():
+    for module_name in task_modules:
+        import_module(module_name)
+
+
+def sources_digest():
+    """Changes whenever a source file or session info changes."""
+    digest = hashlib.blake2b(digest_size=16)
+    sources = glob.glob(os.path.join(paths.code_dir, "*.py"))
+    sources.extend(glob.glob(os.path.join(paths.info_dir, "*.json")))
+    for path in sorted(sources):
+        stat = os.stat(path)
+        digest.update(f"{path}:{stat.st_mtime_ns}:{stat.st_size}".encode())
+    return digest.hexdigest()
+
+
+def session_task():
+    """The SessionTask running all InfoTasks, for fused sessions."""
+    global _session_task
+    if _session_task is None:
+        import_all()
+        _session_task = SessionTask(
+            [task for task in Task.all_tasks if isinstance(task, InfoTask)]
+        )
+    return _session_task
+
+
+def task_objects(fuse_sessions):
+    """Tasks of task_modules, with the InfoTasks fused if fuse_sessions."""
+    import_all()
+    objects = []
+    for module_name in task_modules:
+        module = import_module(module_name)
+        for name in dir(module):
+            obj = getattr(module, name)
+            if isinstance(obj, Task) and obj not in objects:
+                objects.append(obj)
+    if fuse_sessions:
+        objects = [obj for obj in objects if not isinstance(obj, InfoTask)]
+        objects.insert(0, session_task())
+    return objects
+
+
+def meta_digest(meta_values):
+    encoded = json.dumps(meta_values, sort_keys=True).encode()
+    return hashlib.blake2b(encoded, digest_size=16).hexdigest()
+
+
+def _created(obj):
+    created = obj.create_doit_tasks()
+    return [created] if isinstance(created, dict) else list(created)
+
+
+def _reads(obj, name):
+    """The per-session cache groups that a doit task reads."""
+    if isinstance(obj, SessionTask) or (
+        isinstance(obj, InfoTask) and len(obj.cache_loads) > 0
+    ):
+        return [f"ind-{name}"]
+    if isinstance(obj, GroupTask) and any(
+        key.startswith("all_") for key in obj.cache_loads
+    ):
+        return [f"ind-{info.session_id}" for info in obj.groups[name]]
+    return []
+
+
+def _on_demand_inputs(fuse_sessions):
+    """Raw inputs of on-demand tasks, with the doit task that would read them.
+
+    Returns
+    -------
+    on_demand_inputs: list of [name, raw_input]
+        name is None if no task reads raw_input.
+
+    """
+    on_demand_inputs = []
+    for task in InfoTask.on_demand_tasks:
+        for info in task.infos:
+            if not fuse_sessions:
+                name = f"{task.function.__name__}:{info.session_id}"
+            elif task in session_task().session_tasks(info):
+                name = f"{SessionTask.basename}:{info.session_id}"
+            else:
+                name = None
+            on_demand_inputs.extend([name, path] for path in task._raw_inputs(info))
+    return on_demand_inputs
+
+
+def build(fuse_sessions):
+    """Imports all task modules and describes their doit tasks.
+
+    Returns
+    -------
+    manifest: dict
+        With the "tasks" as a list of dicts with the basename, name (None
+        for tasks without sessions or groups), module, doc, file_dep,
+        targets, on_demand, reads (see `_reads`), meta (see
+        `meta_digest`) and loaded_keys (its cache_saves that other tasks
+        load, which it must flush before returning) of each doit task, and
+        the Task.tex_files and FigureTask.figure_files that combine.py's
+        task creators use, as creating the doit tasks lists them.
+
+    """
+    digest = sources_digest()
+    described = []
+    for obj in task_objects(fuse_sessions):
+        if isinstance(obj, SessionTask):
+            module_name, doc = None, SessionTask.__doc__
+        else:
+            module_name, doc = obj.function.__module__, obj.function.__doc__
+        meta = meta_digest(obj.meta_values())
+        loaded_keys = [
+            key for key in getattr(obj, "cache_saves", []) if key in Task.loaded_keys
+        ]
+        for doit_task in _created(obj):
+            described.append(
+                {
+                    "basename": doit_task["basename"],
+                    "name": doit_task.get("name"),
+                    "module": module_name,
+                    "doc": (doc or "").strip().split("\n")[0],
+                    "file_dep": list(doit_task.get("file_dep", [])),
+                    "targets": list(doit_task.get("targets", [])),
+                    "on_demand": getattr(obj, "on_demand", False),
+                    "reads": _reads(obj, doit_task.get("name")),
+                    "meta": meta,
+                    "loaded_keys": loaded_keys,
+                }
+            )
+    return {
+        "sources": digest,
+        "fuse_sessions": fuse_sessions,
+        "tasks": described,
+        "on_demand_inputs": _on_demand_inputs(fuse_sessions),
+        "tex_files": list(Task.tex_files),
+        "figure_files": [list(files) for files in FigureTask.figure_files],
+    }
+
+
+def load(fuse_sessions):
+    """The saved manifest if it is up to date, else a newly built one."""
+    try:
+        with open(paths.task_manifest(), "r") as fileobj:
+            manifest = json.load(fileobj)
+        if (
+            manifest["sources"] == sources_digest()
+            and manifest["fuse_sessions"] == fuse_sessions
+        ):
+            return manifest
+    except (OSError, ValueError, KeyError):
+        pass
+    manifest = build(fuse_sessions)
+    os.makedirs(os.path.dirname(paths.task_manifest()), exist_ok=True)
+    with open(f"{paths.task_manifest()}.tmp", "w") as fileobj:
+        json.dump(manifest, fileobj)
+    os.replace(f"{paths.task_manifest()}.tmp", paths.task_manifest())
+    return manifest
+
+
+def run(module_name, basename, name, loaded_keys):
+    """Action of a doit task from the manifest. Imports its module to run it.
+
+    Only the tasks of that module are imported, so the Task.loaded_keys of
+    tasks in other modules are added from the manifest, for the task to
+    flush the saves that they load (see Task._flush_saves).
+    """
+    Task.loaded_keys.update(loaded_keys)
+    if module_name is None:
+        obj = session_task()
+    else:
+        module = import_module(module_name)
+        obj = next(
+            value
+            for value in vars(module).values()
+            if isinstance(value, Task) and value.function.__name__ == basename
+        )
+    for doit_task in _created(obj):
+        if doit_task.get("name") == name:
+            action, args = doit_task["actions"][0]
+            return action(*args)
+    raise KeyError(f"No task {basename}:{name} in {module_name}")
+
+
+def meta_baselines():
+    """Digests recorded for tasks that last ran before their digest was saved."""
+    global _meta_baselines
+    if _meta_baselines is None:
+        os.makedirs(paths.cache_dir, exist_ok=True)
+        _meta_baselines = sqlite3.connect(paths.task_meta_baselines())
+        _meta_baselines.execute(
+            "CREATE TABLE IF NOT EXISTS baselines (task TEXT PRIMARY KEY, meta TEXT)"
+        )
+    return _meta_baselines
+
+
+class MetaChanged:
+    """doit uptodate check: out of date if the `meta` values read changed.
+
+    Like doit.tools.config_changed, except for tasks that last ran before
+    their digest was saved with their doit values. doit only saves values
+    when a task runs, so for these the digest seen on the first check is
+    kept in paths.task_meta_baselines() and compared against instead. This
+    way, starting to record digests doesn't rerun everything, and changing
+    a value afterwards still reruns the tasks that read it.
+    """
+
+    def __init__(self, digest):
+        self.digest = digest
+
+    def __call__(self, task, values):
+        task.value_savers.append(lambda: {"meta": self.digest})
+        if "meta" in values:
+            return values["meta"] == self.digest
+        db = meta_baselines()
+        with db:
+            db.execute(
+                "INSERT OR IGNORE INTO baselines VALUES (?, ?)",
+                (task.name, self.digest),
+            )
+        (baseline,) = db.execute(
+            "SELECT meta FROM baselines WHERE task = ?", (task.name,)
+        ).fetchone()
+        return baseline == self.digest
+
+
+class ManifestTask:
+    """The doit tasks of one basename, as described in the manifest."""
+
+    def __init__(self, described):
+        self.described = described
+
+    def create_doit_tasks(self):
+        for task in self.described:
+            args = [task["module"], task["basename"], task["name"], task["loaded_keys"]]
+            doit_task = {
+                "basename": task["basename"],
+                "actions": [(run, args)],
+                "doc": task["doc"],
+                "file_dep": task["file_dep"],
+                "targets": task["targets"],
+                "uptodate": [MetaChanged(task["meta"])],
+            }
+            if task["name"] is not None:
+                doit_task["name"] = task["name"]
+            yield doit_task
@@ -250,6 +250,10 @@ load_questionable = False
 max_rate = 5.0
 min_spikes = 100
 
+# cache_position
+unzip_nvt = False  # Extract the .nvt to disk instead of streaming it from the .zip
+position_exports = ["mat"]  # Add "csv" for the (slow, large) text export
+
 # find_trajectories
 merge_gap = 10.0
 
@@ -11,6 +11,9 @@ cache_dir = os.path.abspath(os.path.join(root, "cache"))
 plots_dir = os.path.abspath(os.path.join(root, "plots"))
 info_dir = os.path.abspath(os.path.join(code_dir, "info"))
 thesis_dir = os.path.abspath(os.path.join(code_dir, os.pardir, "thesis"))
+# Local or NFS directory of task results shared between analysts (see
+# artifacts.py), or None to always compute them locally
+artifact_store_dir = None
 
 
 def recording_dir(info):
@@ -21,6 +24,10 @@ def position_file(info):
     return os.path.join(recording_dir(info), f"{info.session}-VT1.nvt")
 
 
+def position_zip_file(info):
+    return os.path.join(recording_dir(info), f"{info.session}-VT1.zip")
+
+
 def event_file(info):
     return os.path.join(recording_dir(info), f"{info.session}-Events.nev")
 
@@ -47,11 +54,51 @@ def position_csv_file(info):
     )
 
 
+def position_mat_file(info):
+    return os.path.join(
+        cache_dir, f"ind-{info.session_id}", f"{info.session}-position.mat"
+    )
+
+
 def cached_file(group, key):
     assert isinstance(key, str)
     return os.path.join(cache_dir, group, f"{key}.pkl")
 
 
+def cached_array(group, key, name):
+    assert isinstance(key, str)
+    return os.path.join(cache_dir, group, f"{key}.{name}.npy")
+
+
+def cached_buffers(group, key):
+    assert isinstance(key, str)
+    return os.path.join(cache_dir, group, f"{key}.buffers")
+
+
+def cache_load_stats():
+    return os.path.join(cache_dir, "load_stats.jsonl")
+
+
+def task_timings():
+    return os.path.join(cache_dir, "task_timings.sqlite")
+
+
+def task_manifest():
+    return os.path.join(cache_dir, "task_manifest.json")
+
+
+def task_meta_baselines():
+    return os.path.join(cache_dir, "task_meta_baselines.sqlite")
+
+
+def raw_fingerprints():
+    return os.path.join(cache_dir, "raw_fingerprints.sqlite")
+
+
+def session_task_states():
+    return os.path.join(cache_dir, "session_task_states.sqlite")
+
+
 def plot_file(*path_args):
     path = os.path.join(plots_dir, *path_args)
     return path
@@ -5,6 +5,7 @@ from shapely.geometry import Point
 
 import meta
 import meta_session
+from plots import plot_lfp_envelope
 from tasks import task
 
 
@@ -149,3 +150,33 @@ def plot_std_distortion(infos, group_name, *, all_lines, savepath):
             transparent=True,
         )
         plt.close(fig)
+
+
+# Only run when asked for by name, as it builds an LFP pyramid for each session
+@task(
+    infos=meta_session.all_infos,
+    savepath=("lfp", "lfp_swr_overview.svg"),
+    on_demand=True,
+)
+def plot_lfp_swr_overview(info, *, lfp_swr_pyramid, task_times, savepath):
+    fig, ax = plt.subplots(figsize=(12, 3))
+    for task_time in meta.task_times:
+        epoch = task_times[task_time]
+        color = meta.colors["run" if task_time in meta.run_times else "rest"]
+        ax.axvspan(epoch.start, epoch.stop, color=color, alpha=0.2, lw=0)
+    plot_lfp_envelope(
+        ax,
+        lfp_swr_pyramid,
+        task_times["all"].start,
+        task_times["all"].stop,
+        n_pixels=2000,
+    )
+    ax.set_yticks([])
+    ax.spines["left"].set_visible(False)
+    ax.spines["right"].set_visible(False)
+    ax.spines["top"].set_visible(False)
+    plt.xlabel("Time (s)", fontsize=meta.fontsize)
+
+    plt.tight_layout()
+    plt.savefig(savepath, bbox_inches="tight", transparent=True)
+    plt.close(fig)
@@ -49,10 +49,7 @@ def plot_swrs(
         if np.isnan(correlation):
             return
         replay = "replays" if i in replays_idx[trajectory] else "swrs"
-        swr_spikes = [
-            spiketrain.time_slice(start, stop)
-            for spiketrain in matched_tc_spikes[trajectory]
-        ]
+        swr_spikes = matched_tc_spikes[trajectory].time_slice(start, stop)
         if show_corr:
             plot_raster(
                 swr_spikes,
@@ -120,10 +117,7 @@ def plot_swrs_without_tuning_curves(
         replay = (
             "replays-without-tc" if i in replays_idx[trajectory] else "swrs-without-tc"
         )
-        swr_spikes = [
-            spiketrain.time_slice(start, stop)
-            for spiketrain in matched_tc_spikes[trajectory]
-        ]
+        swr_spikes = matched_tc_spikes[trajectory].time_slice(start, stop)
         if show_corr:
             plot_raster(
                 swr_spikes,
@@ -191,16 +185,10 @@ def plot_swr_and_matched_run_raster(
             os.makedirs(os.path.dirname(savepath), exist_ok=True)
 
             plot_raster(
-                spikes=[
-                    spiketrain.time_slice(trial.start, trial.stop)
-                    for spiketrain in matched_tc_spikes[trajectory]
-                ],
+                spikes=matched_tc_spikes[trajectory].time_slice(trial.start, trial.stop),
                 xlim=(trial.start, trial.stop),
                 tuning_curves=matched_tuning_curves[trajectory],
-                swr_raster=[
-                    spiketrain.time_slice(swr_start, swr_stop)
-                    for spiketrain in matched_tc_spikes[trajectory]
-                ],
+                swr_raster=matched_tc_spikes[trajectory].time_slice(swr_start, swr_stop),
                 swr_lfp=lfp_swr.time_slice(swr_start, swr_stop),
                 swr_buffer=swr_buffer,
                 savepath=savepath,
@@ -307,6 +307,8 @@ def plot_behavior_bytrial_consecutive(
 def plot_trial_durations_bytrial(
     infos, group_name, *, trial_durations_bytrial, savepath
 ):
+    # Loaded inputs are shared with other tasks
+    trial_durations_bytrial = dict(trial_durations_bytrial)
     del trial_durations_bytrial["exploratory"]
     del trial_durations_bytrial["novel"]
     plot_bytrial(
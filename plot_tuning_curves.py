@@ -1305,7 +1305,7 @@ def plot_tcs(info, *, tuning_curves, savepath):
         fig, ax = plt.subplots(figsize=(4, 10))
         ax.set_prop_cycle(color=[cm(1.0 * i / n_colors) for i in range(n_colors)])
         for i, tuning_curve in enumerate(reversed(tuning_curves[trajectory])):
-            tuning_curve[np.isnan(tuning_curve)] = 0.0
+            tuning_curve = np.where(np.isnan(tuning_curve), 0.0, tuning_curve)
             tc = map_range(tuning_curve, 0, np.max(tuning_curve), i, i + 0.8)
             plt.fill_between(np.arange(tc.size), np.ones_like(tc) * np.min(tc), tc)
 
@@ -55,6 +55,12 @@ def significance_bar(start, end, height, pval):
         )
 
 
+def plot_lfp_envelope(ax, lfp_pyramid, t_start, t_stop, n_pixels, color="k"):
+    time, lfp_min, lfp_max = lfp_pyramid.envelope(t_start, t_stop, n_pixels)
+    ax.fill_between(time, lfp_min, lfp_max, step="post", color=color, lw=0)
+    ax.set_xlim(t_start, t_stop)
+
+
 def plot_raster(
     spikes,
     xlim,
@@ -0,0 +1,70 @@
+"""Version-independent pickling of nept objects for the cache.
+
+Pickling a nept object directly ties the cache to nept's class internals, so
+a nept upgrade can make every cached file unloadable. Instead, cache.save
+pickles each of the `neutral_types` as its name, a schema version and a dict
+of its arrays, and `rebuild` turns that back into the nept object on load.
+
+If nept changes how one of these classes stores its data, update its entry
+here. If the neutral state itself has to change, bump the version and add
+an upgrade from the old version to `upgrades`, so existing caches load.
+"""
+
+import io
+import pickle
+
+# nept class name: (schema version, attributes making up the neutral state).
+# nept is only imported once one of these is pickled or unpickled, as it is
+# slow to import and dodo.py imports the cache without needing it.
+neutral_types = {
+    "AnalogSignal": (1, ["data", "time"]),
+    "Epoch": (1, ["starts", "stops"]),
+    "LocalFieldPotential": (1, ["data", "time"]),
+    "Neurons": (1, ["spikes", "tuning_curves"]),
+    "Position": (1, ["data", "time"]),
+    "SpikeTrain": (1, ["time", "label"]),
+}
+
+# (name, version): function from a state of that version to the next version
+upgrades = {}
+
+
+def rebuild(name, version, state):
+    """Rebuilds a nept object from its neutral state, upgrading old schemas."""
+    import nept
+
+    cls = getattr(nept, name)
+    current_version, attributes = neutral_types[name]
+    while version < current_version:
+        state = upgrades[name, version](state)
+        version += 1
+    assert (
+        version == current_version
+    ), f"{name} schema {version} is newer than this code"
+    # Set the attributes directly, as the constructors copy the arrays
+    obj = cls.__new__(cls)
+    for attribute in attributes:
+        setattr(obj, attribute, state[attribute])
+    return obj
+
+
+class _Pickler(pickle.Pickler):
+    def reducer_override(self, obj):
+        cls = type(obj)
+        name = cls.__name__
+        if not cls.__module__.startswith("nept.") or name not in neutral_types:
+            return NotImplemented
+        import nept
+
+        if getattr(nept, name) is not cls:
+            return NotImplemented
+        version, attributes = neutral_types[name]
+        state = {attribute: getattr(obj, attribute) for attribute in attributes}
+        return rebuild, (name, version, state)
+
+
+def dumps(obj, buffer_callback=None):
+    """pickle.dumps (protocol 5) with nept objects in their neutral state."""
+    fileobj = io.BytesIO()
+    _Pickler(fileobj, protocol=5, buffer_callback=buffer_callback).dump(obj)
+    return fileobj.getvalue()
@@ -0,0 +1,155 @@
+"""Shared memory for hot per-session cache entries.
+
+With `enabled`, the first doit worker to load one of `shared_keys` for a
+session copies it into a multiprocessing.shared_memory segment, and the other
+workers attach to that segment read-only instead of each keeping their own
+copy. The main process counts the scheduled tasks that read each group and
+releases the group's segments once the last of them is done (see dodo.py).
+
+Columnar stores (stores.py) are already memory-mapped from their .npy files,
+so the OS shares their pages between workers without this.
+"""
+
+import hashlib
+import os
+import pickle
+import shutil
+import struct
+import tempfile
+from multiprocessing import shared_memory
+
+if os.name == "posix":
+    from multiprocessing import resource_tracker
+
+enabled = False
+run_id = None  # Set by the main process, inherited by the workers it forks
+shared_keys = ["position", "spikes", "task_times", "trials"]
+alignment = 64
+
+_attached = {}  # Segment name: (group, SharedMemory), open while arrays use it
+
+
+def registry_dir(group=None):
+    """Holds an empty file for each published segment, by group."""
+    path = os.path.join(tempfile.gettempdir(), f"emi_shortcut-shared-{run_id}")
+    return path if group is None else os.path.join(path, group)
+
+
+def _segment_name(group, key, stamp):
+    # Short, as some platforms limit shared memory names to 31 characters
+    digest = hashlib.blake2b(repr((group, key, stamp)).encode(), digest_size=8)
+    return f"emi{run_id}_{digest.hexdigest()}"
+
+
+def _untrack(shm):
+    # Segments outlive the worker that made them; release() unlinks them
+    if os.name == "posix":
+        resource_tracker.unregister(shm._name, "shared_memory")
+
+
+def _unpickle(shm):
+    buf = shm.buf.toreadonly()
+    n_buffers, data_size = struct.unpack_from("<QQ", buf, 0)
+    index = struct.unpack_from(f"<{2 * n_buffers}Q", buf, 16)
+    data_start = 16 + 16 * n_buffers
+    buffers = [
+        buf[offset : offset + nbytes] for offset, nbytes in zip(index[::2], index[1::2])
+    ]
+    return pickle.loads(buf[data_start : data_start + data_size], buffers=buffers)
+
+
+def released_groups():
+    """Groups with segments attached here that the main process has released."""
+    return {
+        group
+        for name, (group, _) in _attached.items()
+        if not os.path.exists(os.path.join(registry_dir(group), name))
+    }
+
+
+def close_released():
+    """Frees this worker's mapping of segments the main process has released.
+
+    Segments that arrays still use stay mapped, so drop references to the
+    objects of released_groups() first (see cache.load).
+    """
+    for name, (group, shm) in list(_attached.items()):
+        if not os.path.exists(os.path.join(registry_dir(group), name)):
+            try:
+                shm.close()
+            except BufferError:
+                continue  # Arrays still use it
+            del _attached[name]
+
+
+def attach(group, key, stamp):
+    """Object published for (group, key, stamp), or None if there is none."""
+    close_released()
+    name = _segment_name(group, key, stamp)
+    if name not in _attached:
+        if not os.path.exists(os.path.join(registry_dir(group), name)):
+            return None
+        try:
+            shm = shared_memory.SharedMemory(name)
+        except FileNotFoundError:
+            return None
+        _untrack(shm)
+        _attached[name] = (group, shm)
+    return _unpickle(_attached[name][1])
+
+
+def publish(group, key, stamp, obj):
+    """Copies obj into shared memory and returns the shared version of it.
+
+    If another worker is publishing the same entry, returns obj unchanged.
+    """
+    close_released()
+    buffers = []
+    data = pickle.dumps(obj, protocol=5, buffer_callback=buffers.append)
+    raws = [buffer.raw() for buffer in buffers]
+
+    header = [len(raws), len(data)]
+    offset = 16 + 16 * len(raws) + len(data)
+    for raw in raws:
+        offset += -offset % alignment
+        header.extend([offset, raw.nbytes])
+        offset += raw.nbytes
+
+    name = _segment_name(group, key, stamp)
+    try:
+        shm = shared_memory.SharedMemory(name, create=True, size=max(offset, 1))
+    except FileExistsError:
+        return obj
+    _untrack(shm)
+    struct.pack_into(f"<{len(header)}Q", shm.buf, 0, *header)
+    data_start = 16 + 16 * len(raws)
+    shm.buf[data_start : data_start + len(data)] = data
+    for raw, raw_offset in zip(raws, header[2::2]):
+        shm.buf[raw_offset : raw_offset + raw.nbytes] = raw
+    _attached[name] = (group, shm)
+
+    # Only attach once the segment is complete
+    os.makedirs(registry_dir(group), exist_ok=True)
+    open(os.path.join(registry_dir(group), name), "w").close()
+    return _unpickle(shm)
+
+
+def release(group):
+    """Unlinks the group's segments. Called from the main process."""
+    if not os.path.isdir(registry_dir(group)):
+        return
+    for name in os.listdir(registry_dir(group)):
+        os.remove(os.path.join(registry_dir(group), name))
+        try:
+            shm = shared_memory.SharedMemory(name)
+        except FileNotFoundError:
+            continue
+        shm.close()
+        shm.unlink()
+
+
+def release_all():
+    if os.path.isdir(registry_dir()):
+        for group in os.listdir(registry_dir()):
+            release(group)
+        shutil.rmtree(registry_dir(), ignore_errors=True)
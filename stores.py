@@ -0,0 +1,377 @@
+"""Columnar stores for large per-session data.
+
+LFPStore is saved as raw .npy arrays: the pickle in paths.cached_file only
+records where the arrays live, the arrays themselves are written next to it by
+cache.save and memory-mapped on load, so slicing a window only reads the pages
+it touches. SpikeStore keeps all spikes of a session in a few flat arrays so
+that slicing many neurons by many intervals is a single searchsorted call.
+LFPPyramid is a min/max envelope of an LFP at several resolutions, for plots.
+"""
+
+import os
+
+import nept
+import numpy as np
+
+import paths
+
+
+def load_array(group, key, name):
+    return np.load(paths.cached_array(group, key, name), mmap_mode="r")
+
+
+def save_array(group, key, name, array):
+    path = paths.cached_array(group, key, name)
+    # Atomic, as other processes may have the old file memory-mapped
+    with open(f"{path}.tmp", "wb") as fileobj:
+        np.save(fileobj, np.ascontiguousarray(array))
+    os.replace(f"{path}.tmp", path)
+
+
+class ArrayStore:
+    """Base for stores whose `arrays` are saved as memory-mapped .npy files."""
+
+    arrays = []
+
+    def save_arrays(self, group, key):
+        for name in self.arrays:
+            save_array(group, key, name, getattr(self, name))
+        self._location = (group, key)
+
+    def __getstate__(self):
+        if self._location is None:
+            # Not saved to the cache (eg. sent to another process), so the
+            # arrays are pickled along
+            return {name: getattr(self, name) for name in self.arrays}
+        return {"location": self._location}
+
+    def __setstate__(self, state):
+        if "location" not in state:
+            self.__init__(**state)
+            return
+        group, key = state["location"]
+        self.__init__(**{name: load_array(group, key, name) for name in self.arrays})
+        self._location = (group, key)
+
+
+class LFPStore(ArrayStore):
+    """Memory-mapped local field potential.
+
+    Parameters
+    ----------
+    data: np.array
+        With shape (n_samples, 1).
+    time: np.array
+        Sorted, with shape (n_samples,).
+
+    Attributes
+    ----------
+    index: np.array
+        Every `index_stride`th sample time, kept in memory to narrow searches
+        to a single block of `time`.
+
+    """
+
+    index_stride = 512
+    arrays = ["data", "time", "index"]
+
+    def __init__(self, data, time, index=None):
+        self.data = data
+        self.time = time
+        self.index = time[:: self.index_stride] if index is None else index
+        self._location = None
+
+    @classmethod
+    def from_lfp(cls, lfp):
+        time = np.asarray(lfp.time)
+        assert np.all(np.diff(time) >= 0), "LFP time must be sorted"
+        return cls(np.asarray(lfp.data), time)
+
+    @property
+    def n_samples(self):
+        return self.time.size
+
+    def _searchsorted(self, t, side):
+        block = np.searchsorted(self.index, t, side=side)
+        lo = max(block - 1, 0) * self.index_stride
+        hi = min(block * self.index_stride + 1, self.n_samples)
+        return lo + np.searchsorted(self.time[lo:hi], t, side=side)
+
+    def sample_slice(self, t_start, t_stop):
+        """Slice of the samples between (and including) t_start and t_stop."""
+        return slice(
+            self._searchsorted(t_start, "left"), self._searchsorted(t_stop, "right")
+        )
+
+    def time_slice(self, t_start, t_stop):
+        """In-memory nept.LocalFieldPotential between (and including) t_start, t_stop."""
+        idx = self.sample_slice(t_start, t_stop)
+        return nept.LocalFieldPotential(
+            np.array(self.data[idx]), np.array(self.time[idx])
+        )
+
+    def to_lfp(self):
+        return nept.LocalFieldPotential(np.array(self.data), np.array(self.time))
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self.index = np.array(self.index)
+
+
+class LFPPyramid(ArrayStore):
+    """Multi-resolution min/max envelope of a local field potential.
+
+    Level 0 summarizes every `base_bin` samples and each following level
+    summarizes `factor` bins of the previous one. All levels are concatenated
+    into the same arrays.
+
+    Parameters
+    ----------
+    time: np.array
+        Time of the first sample in each bin.
+    min: np.array
+    max: np.array
+    level_offsets: np.array
+        Bins of level i are [level_offsets[i]:level_offsets[i + 1]].
+
+    """
+
+    base_bin = 16
+    factor = 4
+    chunk_bins = 2**16
+    arrays = ["time", "min", "max", "level_offsets"]
+
+    def __init__(self, time, min, max, level_offsets):
+        self.time = time
+        self.min = min
+        self.max = max
+        self.level_offsets = np.asarray(level_offsets)
+        self._location = None
+
+    @classmethod
+    def from_lfp(cls, lfp):
+        """Builds the pyramid in chunks, so a memory-mapped LFPStore is not
+        loaded into memory all at once."""
+        n_samples = lfp.time.size
+        if n_samples == 0:
+            # A single, empty level
+            data = np.asarray(lfp.data).ravel()
+            return cls(
+                time=np.asarray(lfp.time)[:0],
+                min=data[:0],
+                max=data[:0],
+                level_offsets=[0, 0],
+            )
+        bin_starts = np.arange(0, n_samples, cls.base_bin)
+
+        times, mins, maxs = [], [], []
+        for chunk_start in range(0, bin_starts.size, cls.chunk_bins):
+            starts = bin_starts[chunk_start : chunk_start + cls.chunk_bins]
+            stop = min(starts[-1] + cls.base_bin, n_samples)
+            data = np.asarray(lfp.data[starts[0] : stop]).ravel()
+            times.append(np.asarray(lfp.time[starts]))
+            mins.append(np.minimum.reduceat(data, starts - starts[0]))
+            maxs.append(np.maximum.reduceat(data, starts - starts[0]))
+        levels = [(np.hstack(times), np.hstack(mins), np.hstack(maxs))]
+
+        while levels[-1][0].size > 1:
+            time, lo, hi = levels[-1]
+            starts = np.arange(0, time.size, cls.factor)
+            levels.append(
+                (
+                    time[starts],
+                    np.minimum.reduceat(lo, starts),
+                    np.maximum.reduceat(hi, starts),
+                )
+            )
+
+        level_offsets = np.zeros(len(levels) + 1, dtype=int)
+        level_offsets[1:] = np.cumsum([time.size for time, _, _ in levels])
+        return cls(
+            time=np.hstack([time for time, _, _ in levels]),
+            min=np.hstack([lo for _, lo, _ in levels]),
+            max=np.hstack([hi for _, _, hi in levels]),
+            level_offsets=level_offsets,
+        )
+
+    @property
+    def n_levels(self):
+        return self.level_offsets.size - 1
+
+    def envelope(self, t_start, t_stop, n_pixels):
+        """Min/max envelope between t_start and t_stop with about n_pixels bins.
+
+        Uses the coarsest level with at least n_pixels bins in the window.
+        Windows shorter than n_pixels * base_bin samples get level 0; use
+        LFPStore.time_slice for those if full-rate data is needed.
+
+        Returns
+        -------
+        time: np.array
+            Start time of each bin.
+        min: np.array
+        max: np.array
+
+        """
+        for level in reversed(range(self.n_levels)):
+            level_bins = slice(self.level_offsets[level], self.level_offsets[level + 1])
+            time = self.time[level_bins]
+            lo = max(np.searchsorted(time, t_start, side="right") - 1, 0)
+            hi = np.searchsorted(time, t_stop, side="right")
+            if hi - lo >= n_pixels or level == 0:
+                bins = slice(level_bins.start + lo, level_bins.start + hi)
+                return (
+                    np.array(self.time[bins]),
+                    np.array(self.min[bins]),
+                    np.array(self.max[bins]),
+                )
+
+
+class SpikeStore:
+    """Spike times of a group of neurons in a compressed sparse row layout.
+
+    Behaves like a list of nept.SpikeTrain (len, iteration and integer
+    indexing), but slicing by intervals is done for all neurons at once.
+
+    Parameters
+    ----------
+    time: np.array
+        Spike times of all neurons.
+    neuron_ids: np.array
+        With shape (n_spikes,), the neuron each spike belongs to.
+    n_neurons: int
+    labels: list or None
+
+    Attributes
+    ----------
+    time: np.array
+        Sorted spike times of all neurons, ties broken by neuron id.
+    neuron_ids: np.array
+    order: np.array
+        Permutation of `time` grouping spikes by neuron.
+    offsets: np.array
+        With shape (n_neurons + 1,). The spikes of neuron i are
+        time[order[offsets[i]:offsets[i + 1]]].
+
+    """
+
+    def __init__(self, time, neuron_ids, n_neurons, labels=None):
+        time = np.asarray(time, dtype=float)
+        neuron_ids = np.asarray(neuron_ids, dtype=int)
+        assert time.shape == neuron_ids.shape
+
+        sort_idx = np.lexsort((neuron_ids, time))
+        self.time = time[sort_idx]
+        self.neuron_ids = neuron_ids[sort_idx]
+        self.n_neurons = n_neurons
+        self.labels = [None] * n_neurons if labels is None else list(labels)
+        self.order = np.argsort(self.neuron_ids, kind="stable")
+        self.offsets = np.zeros(n_neurons + 1, dtype=int)
+        self.offsets[1:] = np.cumsum(np.bincount(self.neuron_ids, minlength=n_neurons))
+
+    @classmethod
+    def from_spiketrains(cls, spiketrains):
+        if isinstance(spiketrains, SpikeStore):
+            return spiketrains
+        spiketrains = list(spiketrains)
+        return cls(
+            time=np.concatenate([[]] + [spiketrain.time for spiketrain in spiketrains]),
+            neuron_ids=np.repeat(
+                np.arange(len(spiketrains)),
+                [spiketrain.n_spikes for spiketrain in spiketrains],
+            ),
+            n_neurons=len(spiketrains),
+            labels=[spiketrain.label for spiketrain in spiketrains],
+        )
+
+    @property
+    def n_spikes(self):
+        """(np.array) Number of spikes for each neuron."""
+        return np.diff(self.offsets)
+
+    def __len__(self):
+        return self.n_neurons
+
+    def __iter__(self):
+        for i in range(self.n_neurons):
+            yield self[i]
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (int, np.integer)):
+            neuron = range(self.n_neurons)[idx]
+            spike_idx = self.order[self.offsets[neuron] : self.offsets[neuron + 1]]
+            return nept.SpikeTrain(self.time[spike_idx], self.labels[neuron])
+
+        # Subset of neurons, renumbered in the order given
+        neurons = np.arange(self.n_neurons)[idx]
+        assert np.unique(neurons).size == neurons.size, "neurons must be unique"
+        new_ids = np.full(self.n_neurons, -1)
+        new_ids[neurons] = np.arange(neurons.size)
+        keep = new_ids[self.neuron_ids] >= 0
+        return SpikeStore(
+            self.time[keep],
+            new_ids[self.neuron_ids[keep]],
+            n_neurons=neurons.size,
+            labels=[self.labels[i] for i in neurons],
+        )
+
+    def interval_slices(self, t_starts, t_stops):
+        """Indices into `time` of the spikes in each interval.
+
+        Intervals include both t_start and t_stop, like nept's time_slice.
+
+        Returns
+        -------
+        lo: np.array
+        hi: np.array
+            Spikes in interval j are time[lo[j]:hi[j]].
+
+        """
+        t_starts = np.atleast_1d(np.asarray(t_starts, dtype=float))
+        t_stops = np.atleast_1d(np.asarray(t_stops, dtype=float))
+        if t_starts.shape != t_stops.shape:
+            raise ValueError("must have same number of start and stop times")
+        lo = np.searchsorted(self.time, t_starts, side="left")
+        hi = np.maximum(np.searchsorted(self.time, t_stops, side="right"), lo)
+        return lo, hi
+
+    def interval_neuron_ids(self, t_starts, t_stops):
+        """Neuron ids of the spikes in each interval, in spike time order."""
+        lo, hi = self.interval_slices(t_starts, t_stops)
+        return [self.neuron_ids[start:stop] for start, stop in zip(lo, hi)]
+
+    def interval_counts(self, t_starts, t_stops):
+        """Spike counts with shape (n_neurons, n_intervals)."""
+        lo, hi = self.interval_slices(t_starts, t_stops)
+        n_per_interval = hi - lo
+        interval = np.repeat(np.arange(lo.size), n_per_interval)
+        spike_idx = np.arange(interval.size) + np.repeat(
+            lo - (np.cumsum(n_per_interval) - n_per_interval), n_per_interval
+        )
+        counts = np.bincount(
+            interval * self.n_neurons + self.neuron_ids[spike_idx],
+            minlength=lo.size * self.n_neurons,
+        )
+        return counts.reshape(lo.size, self.n_neurons).T
+
+    def time_slice(self, t_starts, t_stops):
+        """Spikes of all neurons within the union of the intervals.
+
+        Parameters
+        ----------
+        t_starts: float or np.array
+        t_stops: float or np.array
+
+        Returns
+        -------
+        sliced: SpikeStore
+
+        """
+        lo, hi = self.interval_slices(t_starts, t_stops)
+        edges = np.zeros(self.time.size + 1, dtype=int)
+        np.add.at(edges, lo, 1)
+        np.add.at(edges, hi, -1)
+        keep = np.cumsum(edges[:-1]) > 0
+        return SpikeStore(
+            self.time[keep], self.neuron_ids[keep], self.n_neurons, self.labels
+        )
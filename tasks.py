@@ -1,11 +1,16 @@
 """Convenience classes to reduce boilerplate and automatically load/save from cache."""
 
+import json
 import os
+import sqlite3
 from inspect import getfullargspec
 from keyword import iskeyword
 
+import artifacts
 import cache
+import meta
 import paths
+import timings
 
 
 def _ensure_varname_list(value, name):
@@ -29,14 +34,22 @@ def _ensure_varname_list(value, name):
 
 class Task:
     tex_files = []
+    all_tasks = []
+    loaded_keys = set()  # Cache keys that some task loads
 
-    def __init__(self, function, savepath=None):
+    def __init__(self, function, savepath=None, meta_params=None):
         self.function = function
+        self.meta_params = _ensure_varname_list(meta_params, "meta_params")
         self.cache_loads = getfullargspec(self.function).kwonlyargs
         if "savepath" in self.cache_loads:
             self.cache_loads.remove("savepath")
         if "example_plots" in self.cache_loads:
             self.cache_loads.remove("example_plots")
+        Task.loaded_keys.update(
+            key[len("all_") :] if key.startswith("all_") else key
+            for key in self.cache_loads
+        )
+        Task.all_tasks.append(self)
 
         self.savepath = savepath
         assert self.savepath is None or isinstance(
@@ -48,6 +61,39 @@ class Task:
     def create_doit_tasks(self):
         raise NotImplementedError("Subclasses must implement")
 
+    def _flush_saves(self, group):
+        # With cache.write_behind, only wait for the saves other tasks load
+        cache.flush(
+            [(group, key) for key in self.cache_saves if key in Task.loaded_keys]
+        )
+
+    def meta_values(self):
+        """repr of each `meta` attribute that the task reads, by name.
+
+        These are found in the source of the task and of the functions it
+        calls, plus any declared with `meta_params` (eg. when read through
+        getattr).
+        """
+        _, meta_names = artifacts.code_dependencies(self.function)
+        return {
+            name: repr(getattr(meta, name, None))
+            for name in sorted(set(meta_names) | set(self.meta_params))
+        }
+
+    def _artifact(self, group, input_files):
+        # Only tasks whose results are all cache entries are shared
+        if (
+            not artifacts.enabled()
+            or self.savepath is not None
+            or len(self.cache_saves) == 0
+        ):
+            return None
+        # Inputs saved earlier in this worker must be on disk to be digested
+        cache.flush()
+        return artifacts.artifact_id(
+            self.function, self.meta_values(), group, self.cache_saves, input_files
+        )
+
     def _format_savepath(self, mkdir=False, **fmt_args):
         def tuple_to_path(args):
             if "info" in fmt_args:
@@ -100,6 +146,8 @@ class ExamplePlots:
 
 
 class InfoTask(Task):
+    on_demand_tasks = []  # Only run when another task depends on them
+
     def __init__(
         self,
         function,
@@ -108,10 +156,17 @@ class InfoTask(Task):
         read_example_plots=None,
         write_example_plots=None,
         savepath=None,
+        on_demand=False,
+        raw_inputs=None,
+        meta_params=None,
     ):
         assert isinstance(infos, list)
         assert len(infos) > 0
         self.infos = infos
+        self.on_demand = on_demand
+        if on_demand:
+            InfoTask.on_demand_tasks.append(self)
+        self.raw_inputs = raw_inputs
         self.cache_saves = _ensure_varname_list(cache_saves, "cache_saves")
         self.read_example_plots = _ensure_varname_list(
             read_example_plots, "read_example_plots"
@@ -119,11 +174,38 @@ class InfoTask(Task):
         self.write_example_plots = _ensure_varname_list(
             write_example_plots, "write_example_plots"
         )
-        super().__init__(function=function, savepath=savepath)
+        super().__init__(function=function, savepath=savepath, meta_params=meta_params)
 
     def __call__(self, info, **kwargs):
+        self.run(info, **kwargs)
+
+    def run(self, info, in_memory=None, **kwargs):
+        """Runs the task for one session.
+
+        Parameters
+        ----------
+        info: module
+        in_memory: dict or None
+            Values of cache entries that are already loaded, used instead of
+            loading them again. Unlike kwargs, these are what is in the cache,
+            so the artifact store is still used.
+
+        Returns
+        -------
+        saved: dict
+            The values saved to the cache, by key. Empty if the results
+            were fetched from the artifact store instead.
+
+        """
+        group = f"ind-{info.session_id}"
+        artifact = (
+            None if len(kwargs) > 0 else self._artifact(group, self._file_dep(info))
+        )
+        if artifact is not None and artifacts.fetch(artifact, group, self.cache_saves):
+            return {}
+        in_memory = {} if in_memory is None else in_memory
         loaded = {
-            key: cache.load(f"ind-{info.session_id}", key)
+            key: in_memory[key] if key in in_memory else cache.load(group, key)
             for key in self.cache_loads
             if key not in kwargs
         }
@@ -136,15 +218,30 @@ class InfoTask(Task):
         retval = self.function(info, **kwargs)
         if len(self.cache_saves) == 0:
             assert retval is None
+            saved = {}
         elif len(self.cache_saves) == 1:
-            cache.save(f"ind-{info.session_id}", self.cache_saves[0], retval)
+            saved = {self.cache_saves[0]: retval}
         else:
             assert isinstance(retval, dict)
-            for key in self.cache_saves:
-                cache.save(f"ind-{info.session_id}", key, retval[key])
+            saved = {key: retval[key] for key in self.cache_saves}
+        for key, value in saved.items():
+            cache.save(group, key, value)
+        self._flush_saves(group)
+        if artifact is not None:
+            artifacts.publish(artifact, group, self.cache_saves)
+        return saved
+
+    def _artifact(self, group, input_files):
+        if len(self.read_example_plots + self.write_example_plots) > 0:
+            return None
+        return super()._artifact(group, input_files)
+
+    def _raw_inputs(self, info):
+        return [] if self.raw_inputs is None else list(self.raw_inputs(info))
 
     def _file_dep(self, info):
         file_dep = [info.path]
+        file_dep.extend(self._raw_inputs(info))
         file_dep.extend(
             paths.cached_file(f"ind-{info.session_id}", key=key)
             for key in self.cache_loads
@@ -176,12 +273,185 @@ class InfoTask(Task):
             yield {
                 "basename": self.function.__name__,
                 "name": info.session_id,
-                "actions": [(self.__call__, [info])],
+                "actions": [(timings.measure, [self.__call__, info])],
                 "file_dep": self._file_dep(info),
                 "targets": self._targets(info),
             }
 
 
+class SessionTask:
+    """Runs all InfoTasks of each session as a single doit task.
+
+    The InfoTasks run in dependency order in one worker, and the values they
+    save are passed on in memory to the tasks that load them, instead of
+    being loaded back from the cache. Each value is dropped once the last
+    task that loads it has run. Every cache entry is still saved, as it is
+    a target that GroupTasks and later runs depend on. On-demand tasks only
+    run if a task of the session needs them.
+
+    The doit task reruns when any of its InfoTasks is out of date, but an
+    InfoTask is skipped if its targets exist, no task it depends on ran,
+    and the `meta` values it reads and the fingerprints of its inputs are
+    those of its last run (see `subtask_state`, kept in
+    paths.session_task_states()).
+    """
+
+    basename = "sessions"
+
+    def __init__(self, tasks):
+        self.tasks = _dependency_order(tasks)
+
+    def meta_values(self):
+        values = {}
+        for task in self.tasks:
+            values.update(task.meta_values())
+        return dict(sorted(values.items()))
+
+    def session_tasks(self, info):
+        """The tasks to run for info, in dependency order."""
+        tasks = [
+            task
+            for task in self.tasks
+            if any(task_info.session_id == info.session_id for task_info in task.infos)
+        ]
+        needed = set()
+        for task in reversed(tasks):
+            if not task.on_demand or any(
+                task in _dependencies(other, tasks) for other in needed
+            ):
+                needed.add(task)
+        return [task for task in tasks if task in needed]
+
+    @staticmethod
+    def subtask_state(task, info):
+        """What the results of task for info depend on, or None if an input
+        is missing or has no fingerprint."""
+        inputs = {}
+        for path in task._file_dep(info):
+            if not os.path.exists(path):
+                return None
+            inputs[path] = artifacts.input_fingerprint(path)
+            if inputs[path] is None:
+                return None
+        return {"meta": task.meta_values(), "inputs": inputs}
+
+    def __call__(self, info):
+        tasks = self.session_tasks(info)
+        states = _session_task_states(info.session_id)
+        last_use = {}
+        for i, task in enumerate(tasks):
+            for key in task.cache_loads:
+                last_use[key] = i
+        in_memory = {}
+        ran = []
+        for i, task in enumerate(tasks):
+            name = task.function.__name__
+            if (
+                states.get(name) is not None
+                and not any(other in ran for other in _dependencies(task, tasks))
+                and all(os.path.exists(target) for target in task._targets(info))
+                and states[name] == self.subtask_state(task, info)
+            ):
+                print(f"-- {name}:{info.session_id}")
+                continue
+            saved = task.run(info, in_memory=in_memory)
+            ran.append(task)
+            in_memory.update(
+                (key, value)
+                for key, value in saved.items()
+                if last_use.get(key, -1) > i
+            )
+            for key in [key for key in in_memory if last_use[key] <= i]:
+                del in_memory[key]
+        cache.flush()
+        # Once flushed, so that the digests of the entries saved are written
+        _save_session_task_states(
+            info.session_id,
+            {task.function.__name__: self.subtask_state(task, info) for task in ran},
+        )
+
+    def create_doit_tasks(self):
+        infos = {}
+        for task in self.tasks:
+            for info in task.infos:
+                infos.setdefault(info.session_id, info)
+        for session_id, info in infos.items():
+            tasks = self.session_tasks(info)
+            targets = [target for task in tasks for target in task._targets(info)]
+            file_dep = {
+                path
+                for task in tasks
+                for path in task._file_dep(info)
+                if path not in targets
+            }
+            yield {
+                "basename": self.basename,
+                "name": session_id,
+                "actions": [(timings.measure, [self.__call__, info])],
+                "file_dep": sorted(file_dep),
+                "targets": targets,
+            }
+
+
+def _connect_session_task_states():
+    os.makedirs(paths.cache_dir, exist_ok=True)
+    db = sqlite3.connect(paths.session_task_states())
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS states"
+        " (session TEXT, task TEXT, state TEXT, PRIMARY KEY (session, task))"
+    )
+    return db
+
+
+def _session_task_states(session_id):
+    """SessionTask.subtask_state of each task's last run for the session."""
+    db = _connect_session_task_states()
+    rows = db.execute(
+        "SELECT task, state FROM states WHERE session = ?", (session_id,)
+    ).fetchall()
+    db.close()
+    return {name: json.loads(state) for name, state in rows}
+
+
+def _save_session_task_states(session_id, states):
+    db = _connect_session_task_states()
+    with db:
+        db.executemany(
+            "INSERT OR REPLACE INTO states VALUES (?, ?, ?)",
+            [(session_id, name, json.dumps(state)) for name, state in states.items()],
+        )
+    db.close()
+
+
+def _dependencies(task, tasks):
+    """The tasks in tasks whose cache entries or example plots task reads."""
+    return [
+        other
+        for other in tasks
+        if other is not task
+        and (
+            any(key in other.cache_saves for key in task.cache_loads)
+            or any(key in other.write_example_plots for key in task.read_example_plots)
+        )
+    ]
+
+
+def _dependency_order(tasks):
+    ordered = []
+
+    def visit(task, visiting):
+        if task in ordered:
+            return
+        assert task not in visiting, f"{task.function.__name__} depends on itself"
+        for dependency in _dependencies(task, tasks):
+            visit(dependency, visiting | {task})
+        ordered.append(task)
+
+    for task in tasks:
+        visit(task, set())
+    return ordered
+
+
 class GroupTask(Task):
     def __init__(
         self,
@@ -189,14 +459,23 @@ class GroupTask(Task):
         groups,
         cache_saves=None,
         savepath=None,
+        meta_params=None,
     ):
         assert isinstance(groups, dict)
         assert len(groups) > 0
         self.groups = groups
         self.cache_saves = _ensure_varname_list(cache_saves, "cache_saves")
-        super().__init__(function=function, savepath=savepath)
+        super().__init__(function=function, savepath=savepath, meta_params=meta_params)
 
     def __call__(self, infos, group_name, **kwargs):
+        group = f"grp-{group_name}"
+        artifact = (
+            None
+            if len(kwargs) > 0
+            else self._artifact(group, self._file_dep(infos, group_name))
+        )
+        if artifact is not None and artifacts.fetch(artifact, group, self.cache_saves):
+            return
         loaded = {
             key: (
                 [
@@ -223,6 +502,9 @@ class GroupTask(Task):
             assert isinstance(retval, dict)
             for key in self.cache_saves:
                 cache.save(f"grp-{group_name}", key, retval[key])
+        self._flush_saves(group)
+        if artifact is not None:
+            artifacts.publish(artifact, group, self.cache_saves)
 
     def _file_dep(self, infos, group_name):
         file_dep = []
@@ -260,7 +542,7 @@ class GroupTask(Task):
             yield {
                 "basename": self.function.__name__,
                 "name": group_name,
-                "actions": [(self.__call__, [infos, group_name])],
+                "actions": [(timings.measure, [self.__call__, infos, group_name])],
                 "file_dep": self._file_dep(infos, group_name),
                 "targets": self._targets(infos, group_name),
             }
@@ -269,13 +551,13 @@ class GroupTask(Task):
 class FigureTask(Task):
     figure_files = []  # All the savepaths for these tasks
 
-    def __init__(self, function, panels, copy_to, savepath):
+    def __init__(self, function, panels, copy_to, savepath, meta_params=None):
         assert savepath is not None
         self.panels = {
             key: paths.plot_file(*pathargs) for key, pathargs in panels.items()
         }
         self.copy_to = copy_to
-        super().__init__(function, savepath)
+        super().__init__(function, savepath, meta_params=meta_params)
 
     def __call__(self, **kwargs):
         if self.savepath is not None and "savepath" not in kwargs:
@@ -295,7 +577,7 @@ class FigureTask(Task):
 
         return {
             "basename": self.function.__name__,
-            "actions": [(self.__call__, [])],
+            "actions": [(timings.measure, [self.__call__])],
             "file_dep": list(self.panels.values()),
             "targets": [target],
         }
@@ -311,8 +593,13 @@ def task(
     cache_saves=None,
     savepath=None,
     copy_to=None,
+    on_demand=False,
+    raw_inputs=None,
+    meta_params=None,
 ):
     def decorator(function):
+        if infos is None:
+            assert not on_demand and raw_inputs is None
         if infos is not None:
             assert groups is None and panels is None and copy_to is None
         elif groups is not None:
@@ -335,12 +622,21 @@ def task(
                 read_example_plots=read_example_plots,
                 write_example_plots=write_example_plots,
                 savepath=savepath,
+                on_demand=on_demand,
+                raw_inputs=raw_inputs,
+                meta_params=meta_params,
             )
         elif groups is not None:
             return GroupTask(
-                function, groups, cache_saves=cache_saves, savepath=savepath
+                function,
+                groups,
+                cache_saves=cache_saves,
+                savepath=savepath,
+                meta_params=meta_params,
             )
-        return FigureTask(function, panels, copy_to, savepath=savepath)
+        return FigureTask(
+            function, panels, copy_to, savepath=savepath, meta_params=meta_params
+        )
 
     return decorator
 
@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+
+import analyze_data
+
+
+def remove_based_on_std_loop(original_targets, std_thresh):
+    # The loop that remove_based_on_std replaced, walking each problem sample
+    targets = np.array(original_targets)
+    stds = np.nanstd(targets, axis=1)[:, np.newaxis]
+
+    # find idx where there is a large variation between targets
+    problem_samples = np.where(stds > std_thresh)[0]
+
+    for i in problem_samples:
+        # find the previous mean to help determine which target is an issue
+        previous_idx = i - 1
+        previous_mean = np.nanmean(targets[previous_idx])
+
+        # if previous sample is nan, compare current sample to the one before that
+        while np.isnan(previous_mean):
+            previous_idx -= 1
+            previous_mean = np.nanmean(targets[previous_idx])
+
+        # remove problem target
+        idx = np.nanargmax(np.abs(targets[i] - previous_mean))
+        targets[i][idx] = np.nan
+
+    return targets
+
+
+def synthetic_targets(n_samples, rng, n_targets=50, p_outlier=0.05):
+    # Smooth trajectory tracked by a few targets, with outliers and dropouts
+    path = np.cumsum(rng.normal(0, 0.5, n_samples)) + 100
+    n_tracked = rng.integers(0, 5, size=n_samples)
+    targets = np.full((n_samples, n_targets), np.nan)
+    for i in range(4):
+        tracked = n_tracked > i
+        targets[tracked, i] = path[tracked] + rng.normal(0, 0.5, tracked.sum())
+    outliers = rng.random(targets.shape) < p_outlier
+    targets[outliers & ~np.isnan(targets)] += rng.normal(0, 50, size=targets.shape)[
+        outliers & ~np.isnan(targets)
+    ]
+    return targets
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_remove_based_on_std_matches_loop(seed):
+    targets = synthetic_targets(5000, np.random.default_rng(seed))
+
+    expected = remove_based_on_std_loop(targets, std_thresh=2.0)
+    removed = analyze_data.remove_based_on_std(targets, std_thresh=2.0)
+
+    assert np.array_equal(removed, expected, equal_nan=True)
+
+
+def test_remove_based_on_std_without_outliers():
+    targets = synthetic_targets(1000, np.random.default_rng(0), p_outlier=0)
+
+    removed = analyze_data.remove_based_on_std(targets, std_thresh=100.0)
+
+    assert np.array_equal(removed, targets, equal_nan=True)
+    assert np.array_equal(
+        remove_based_on_std_loop(targets, std_thresh=100.0), removed, equal_nan=True
+    )
+
+
+def test_remove_based_on_std_all_outliers():
+    # Every sample has a far-off target, including the first, which is
+    # compared to the last sample
+    rng = np.random.default_rng(0)
+    targets = np.full((1000, 50), np.nan)
+    targets[:, 0] = np.cumsum(rng.normal(0, 0.5, 1000)) + 100
+    targets[:, 1] = targets[:, 0] + rng.normal(0, 0.5, 1000)
+    targets[:, 2] = targets[:, 0] + rng.choice([-1, 1], 1000) * rng.uniform(
+        50, 100, 1000
+    )
+    assert np.all(np.nanstd(targets, axis=1) > 2.0)
+
+    expected = remove_based_on_std_loop(targets, std_thresh=2.0)
+    removed = analyze_data.remove_based_on_std(targets, std_thresh=2.0)
+
+    assert np.array_equal(removed, expected, equal_nan=True)
+    assert np.all(np.isnan(removed[:, 2]))
@@ -0,0 +1,347 @@
+"""Resource use of past doit tasks, to start the longest chains first and
+to catch performance regressions.
+
+Each task's action runs through `measure`, which returns the task's CPU
+time, peak memory and cache bytes read and written as its doit values.
+TimedConsoleReporter (dodo.py) records these with the wall time and git
+revision in a small sqlite database in paths.cache_dir.
+
+On the next run, each task is ranked by the estimated duration of the
+longest chain of tasks that starts with it, and dodo.py lists higher ranked
+tasks first, so that doit starts them first. Without this, doit starts tasks
+in the order they are defined and the slow chains of big sessions can be
+left for last. `doit timing_report` summarizes the history.
+"""
+
+import os
+import sqlite3
+import subprocess
+import sys
+import time
+from statistics import median
+
+import cache
+import paths
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+history_runs = 5  # Estimates are the median of this many latest runs
+regression_min_seconds = 1.0  # Faster tasks are too noisy to report
+
+columns = {
+    "task": "TEXT",
+    "session": "TEXT",
+    "duration": "REAL",  # Wall time, in seconds
+    "finished": "REAL",
+    "cpu": "REAL",  # In seconds
+    "peak_rss": "INTEGER",  # In bytes
+    "bytes_read": "INTEGER",
+    "bytes_written": "INTEGER",
+    "revision": "TEXT",
+}
+
+
+def connect():
+    os.makedirs(paths.cache_dir, exist_ok=True)
+    db = sqlite3.connect(paths.task_timings())
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS timings"
+        f" ({', '.join(f'{name} {kind}' for name, kind in columns.items())})"
+    )
+    # Databases recorded before all columns existed
+    existing = [row[1] for row in db.execute("PRAGMA table_info(timings)")]
+    for name, kind in columns.items():
+        if name not in existing:
+            db.execute(f"ALTER TABLE timings ADD COLUMN {name} {kind}")
+    return db
+
+
+def git_revision():
+    """Short hash of the checked out commit, with "-dirty" if there are
+    uncommitted changes, or None outside of a git repository."""
+    try:
+        revision = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=paths.code_dir,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+        status = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=paths.code_dir,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return f"{revision}-dirty" if status.strip() else revision
+
+
+def _reset_peak_rss():
+    # Linux only: resets the peak to the current resident memory
+    try:
+        with open("/proc/self/clear_refs", "w") as fileobj:
+            fileobj.write("5")
+    except OSError:
+        pass
+
+
+def _peak_rss():
+    try:
+        with open("/proc/self/status", "r") as fileobj:
+            for line in fileobj:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    # Peak over the whole life of the process
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def measure(action, *args):
+    """Runs action(*args) and returns what it used, as doit task values.
+
+    Bytes written are those of the objects the action saved, before
+    compression (see cache.io_bytes).
+    """
+    _reset_peak_rss()
+    cpu = time.process_time()
+    bytes_read = cache.io_bytes["read"]
+    bytes_written = cache.io_bytes["written"]
+    action(*args)
+    return {
+        "cpu": time.process_time() - cpu,
+        "peak_rss": _peak_rss(),
+        "bytes_read": cache.io_bytes["read"] - bytes_read,
+        "bytes_written": cache.io_bytes["written"] - bytes_written,
+    }
+
+
+def record(db, name, duration, values=None, revision=None):
+    """Records a run of the doit task called name.
+
+    Parameters
+    ----------
+    db: sqlite3.Connection
+    name: str
+        Like "cache_swrs:R068d1", or just the task for tasks without
+        sessions or groups.
+    duration: float
+        Wall time, in seconds.
+    values: dict or None
+        As returned by `measure`.
+    revision: str or None
+        From `git_revision`.
+
+    """
+    task, _, session = name.partition(":")
+    row = {
+        "task": task,
+        "session": session,
+        "duration": duration,
+        "finished": time.time(),
+        "revision": revision,
+    }
+    if values is not None:
+        row.update(
+            (name, values.get(name))
+            for name in ["cpu", "peak_rss", "bytes_read", "bytes_written"]
+        )
+    with db:
+        db.execute(
+            f"INSERT INTO timings ({', '.join(row)})"
+            f" VALUES ({', '.join('?' for _ in row)})",
+            list(row.values()),
+        )
+
+
+def read_history():
+    """Recorded runs of each doit task.
+
+    Returns
+    -------
+    runs: dict
+        With doit task names as keys and lists of runs, oldest first, as
+        values. Each run is a dict with `columns` as keys.
+
+    """
+    db = connect()
+    rows = db.execute(
+        f"SELECT {', '.join(columns)} FROM timings ORDER BY finished"
+    ).fetchall()
+    db.close()
+    runs = {}
+    for values in rows:
+        run = dict(zip(columns, values))
+        name = f"{run['task']}:{run['session']}" if run["session"] else run["task"]
+        runs.setdefault(name, []).append(run)
+    return runs
+
+
+def estimates():
+    """Estimated duration of each doit task, by task name.
+
+    Tasks that have not run for a session are estimated by their median
+    over the other sessions.
+    """
+    estimated = {}
+    bytask = {}
+    for name, runs in read_history().items():
+        estimated[name] = median(run["duration"] for run in runs[-history_runs:])
+        bytask.setdefault(name.split(":")[0], []).append(estimated[name])
+    for task, task_estimates in bytask.items():
+        estimated.setdefault(task, median(task_estimates))
+    return estimated
+
+
+def chain_lengths(doit_tasks, estimated):
+    """Estimated duration of the longest chain of tasks starting at each task.
+
+    Parameters
+    ----------
+    doit_tasks: list of dict
+        As yielded by create_doit_tasks, with their full name as "name".
+    estimated: dict
+        From `estimates`.
+
+    Returns
+    -------
+    lengths: dict
+        With the names of doit_tasks as keys.
+
+    """
+    producers = {
+        target: doit_task["name"]
+        for doit_task in doit_tasks
+        for target in doit_task.get("targets", [])
+    }
+    dependents = {doit_task["name"]: set() for doit_task in doit_tasks}
+    for doit_task in doit_tasks:
+        for path in doit_task.get("file_dep", []):
+            if path in producers:
+                dependents[producers[path]].add(doit_task["name"])
+
+    def estimate(name):
+        if name in estimated:
+            return estimated[name]
+        return estimated.get(name.split(":")[0], 0.0)
+
+    lengths = {}
+
+    def length(name):
+        if name not in lengths:
+            lengths[name] = estimate(name) + max(
+                (length(dependent) for dependent in dependents[name]), default=0.0
+            )
+        return lengths[name]
+
+    for name in dependents:
+        length(name)
+    return lengths
+
+
+def regressions(runs, threshold):
+    """Tasks whose latest run was more than threshold percent slower than the
+    median of the `history_runs` runs before it.
+
+    Returns
+    -------
+    regressed: list of (name, latest, rolling_median) tuples
+        Durations in seconds, most slowed down first.
+
+    """
+    regressed = []
+    for name, task_runs in runs.items():
+        if len(task_runs) < 2:
+            continue
+        latest = task_runs[-1]["duration"]
+        rolling_median = median(
+            run["duration"] for run in task_runs[-history_runs - 1 : -1]
+        )
+        if latest >= regression_min_seconds and latest > rolling_median * (
+            1 + threshold / 100
+        ):
+            regressed.append((name, latest, rolling_median))
+    return sorted(regressed, key=lambda item: item[2] - item[1])
+
+
+def _format(value, scale=1, unit="s", decimals=1):
+    return "-" if value is None else f"{value / scale:.{decimals}f}{unit}"
+
+
+def timing_report(top, threshold):
+    runs = read_history()
+    if len(runs) == 0:
+        print(f"No timings recorded in {paths.task_timings()} yet")
+        return
+
+    print(f"Slowest {top} tasks, by their latest run:")
+    print(
+        f"{'task':<50} {'wall':>8} {'cpu':>8} {'peak rss':>9} {'read':>9}"
+        f" {'written':>9} {'revision':>14}  trend (oldest to latest)"
+    )
+    slowest = sorted(runs.items(), key=lambda item: -item[1][-1]["duration"])
+    for name, task_runs in slowest[:top]:
+        latest = task_runs[-1]
+        trend = " ".join(_format(run["duration"]) for run in task_runs[-history_runs:])
+        print(
+            f"{name:<50} {_format(latest['duration']):>8}"
+            f" {_format(latest['cpu']):>8}"
+            f" {_format(latest['peak_rss'], 2**20, ' MB', 0):>9}"
+            f" {_format(latest['bytes_read'], 2**20, ' MB', 0):>9}"
+            f" {_format(latest['bytes_written'], 2**20, ' MB', 0):>9}"
+            f" {latest['revision'] or '-':>14}  {trend}"
+        )
+
+    regressed = regressions(runs, threshold)
+    print(f"\n{len(regressed)} tasks more than {threshold:g}% slower than before:")
+    for name, latest, rolling_median in regressed:
+        revisions = {
+            run["revision"] or "-" for run in runs[name][-history_runs - 1 : -1]
+        }
+        slower = (
+            f"+{100 * (latest / rolling_median - 1):.0f}%"
+            if rolling_median > 0
+            else "new"
+        )
+        print(
+            f"{name:<50} {_format(rolling_median):>8} -> {_format(latest):>8}"
+            f" ({slower}) at {runs[name][-1]['revision'] or '-'},"
+            f" was {', '.join(sorted(revisions))}"
+        )
+
+
+def task_timing_report():
+    return {
+        "actions": [(timing_report,)],
+        "params": [
+            {
+                "name": "top",
+                "long": "top",
+                "type": int,
+                "default": 20,
+                "help": "Number of slowest tasks to show",
+            },
+            {
+                "name": "threshold",
+                "long": "threshold",
+                "type": float,
+                "default": 25.0,
+                "help": "Report tasks this many percent slower than their median",
+            },
+        ],
+        "uptodate": [False],
+        "verbosity": 2,
+    }
+
+
+# Only run when asked for by name
+task_timing_report.on_demand = True